@@ -0,0 +1,536 @@
+"""
+Change Events
+
+Cross-process signal for changes to watched collections ("assessment" by
+default). Every worker runs one watcher thread that tails a MongoDB change
+stream, or polls an (updated_at, _id) index on standalone servers where change
+streams are unavailable. Each change is published to the in-process caches
+registered with `register_cache`, so every worker invalidates its own copies.
+
+Only the worker that holds a collection's leader lease spools its events for
+webhooks (into the "event_outbox" collection) and persists the resume
+position (change-stream token or polling cursor) in "event_cursor", so
+webhooks are not multiplied by the number of workers. The position is saved
+only after the events before it were spooled, and a worker that takes over
+the lease resumes from it, so restarts and failovers replay rather than miss
+events (at-least-once). Delivery from the outbox is a separate batched asyncio
+dispatcher with its own lease, so a slow or failing webhook never holds up
+the watchers or cache invalidation.
+"""
+
+import asyncio
+import os
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import requests
+from pymongo import ASCENDING, ReturnDocument
+from pymongo import errors as mongo_errors
+
+import database
+
+WATCHED_COLLECTIONS = [c for c in os.getenv("EVENTS_COLLECTIONS", "assessment").split(",") if c]
+WEBHOOK_URLS = [u for u in os.getenv("EVENTS_WEBHOOK_URLS", "").split(",") if u]
+POLL_INTERVAL_S = float(os.getenv("EVENTS_POLL_INTERVAL_S", 1.0))
+BATCH_SIZE = int(os.getenv("EVENTS_BATCH_SIZE", 100))
+BATCH_WAIT_S = float(os.getenv("EVENTS_BATCH_WAIT_S", 0.25))
+WEBHOOK_TIMEOUT_S = float(os.getenv("EVENTS_WEBHOOK_TIMEOUT_S", 5.0))
+LEASE_S = float(os.getenv("EVENTS_LEASE_S", 15.0))
+# Polling re-scans this far behind the newest updated_at (late commits)
+POLL_LAG_S = float(os.getenv("EVENTS_POLL_LAG_S", 10.0))
+# Events still undelivered after this long are dropped from the outbox
+OUTBOX_TTL_S = int(os.getenv("EVENTS_OUTBOX_TTL_S", 7 * 24 * 3600))
+CURSOR_COLLECTION = "event_cursor"
+OUTBOX_COLLECTION = "event_outbox"
+
+# Server codes meaning change streams are not available (standalone / not supported)
+_NO_CHANGE_STREAM_CODES = {40573, 40324, 115}
+# Resume token no longer in the oplog
+_HISTORY_LOST_CODES = {280, 286}
+
+_caches: Dict[str, Callable[[Dict[str, Any]], None]] = {}
+_caches_lock = threading.Lock()
+_stats: Dict[str, int] = {}
+_stats_lock = threading.Lock()
+
+
+def _incr(name: str, amount: int = 1):
+    with _stats_lock:
+        _stats[name] = _stats.get(name, 0) + amount
+
+
+def register_cache(name: str, invalidate: Callable[[Dict[str, Any]], None]):
+    """Register an in-process cache; `invalidate(event)` runs for every change.
+
+    Events carry `collection`, `operation`, `document_id` and `at`. An event
+    with operation "flush" means history was lost and the cache must be cleared.
+    """
+    with _caches_lock:
+        _caches[name] = invalidate
+
+
+def register_webhook(url: str):
+    """Add a webhook URL in this process (used if this worker holds the lease)"""
+    if url not in WEBHOOK_URLS:
+        WEBHOOK_URLS.append(url)
+
+
+def _notify_caches(event: Dict[str, Any]):
+    with _caches_lock:
+        callbacks = list(_caches.items())
+    for name, invalidate in callbacks:
+        try:
+            invalidate(event)
+            _incr("cache_invalidations")
+        except Exception:
+            _incr(f"cache_errors.{name}")
+
+
+# =============================================================================
+# LEASES
+# =============================================================================
+
+class _Lease:
+    """Time-limited ownership of a role, stored in the "event_cursor" collection"""
+
+    def __init__(self, lease_id: str, worker_id: str):
+        self.lease_id = lease_id
+        self.worker_id = worker_id
+        self.held = False
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+
+    def refresh(self) -> bool:
+        with self._lock:
+            return self._refresh()
+
+    def _refresh(self) -> bool:
+        if time.monotonic() - self._checked_at < LEASE_S / 3:
+            return self.held
+        self._checked_at = time.monotonic()
+        now = datetime.now(timezone.utc)
+        try:
+            database.db[CURSOR_COLLECTION].find_one_and_update(
+                {"_id": self.lease_id, "$or": [{"owner": self.worker_id}, {"expires_at": {"$lt": now}}]},
+                {"$set": {"owner": self.worker_id, "expires_at": now + timedelta(seconds=LEASE_S)}},
+                upsert=True,
+                return_document=ReturnDocument.AFTER,
+            )
+            self.held = True
+        except mongo_errors.DuplicateKeyError:
+            self.held = False
+        except mongo_errors.PyMongoError:
+            self.held = False
+            _incr("lease_errors")
+        return self.held
+
+    def acquired(self) -> bool:
+        """Refresh; True only on the follower -> leader transition"""
+        was_held = self.held
+        return self.refresh() and not was_held
+
+
+# =============================================================================
+# WEBHOOK OUTBOX
+# =============================================================================
+
+class WebhookDispatcher:
+    """Durable webhook fan-out through the "event_outbox" collection.
+
+    The leading watcher spools each event with `spool` (one insert, keyed so a
+    replayed event is stored once) and moves on; it never waits for webhooks.
+    Delivery runs on an asyncio loop in a background thread, in whichever
+    worker holds the outbox lease, with one task per webhook URL: each URL
+    reads the oldest events still pending for it, POSTs them as a batch and
+    pulls itself from their `pending` list, retrying with capped backoff. A
+    failing webhook only delays its own events. Fully delivered events are
+    deleted; undeliverable ones expire after OUTBOX_TTL_S.
+    """
+
+    def __init__(self, worker_id: str):
+        self._lease = _Lease("leader:outbox", worker_id)
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._thread: Optional[threading.Thread] = None
+        self._stopping = threading.Event()
+        self._wakeup: Optional[asyncio.Event] = None
+        self._tasks: Dict[str, asyncio.Task] = {}
+        self._indexes_ready = False
+
+    @property
+    def is_leader(self) -> bool:
+        return self._lease.held
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stopping.clear()
+        ready = threading.Event()
+
+        def run():
+            self._loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(self._loop)
+            self._wakeup = asyncio.Event()
+            ready.set()
+            self._loop.run_until_complete(self._main())
+
+        self._thread = threading.Thread(target=run, name="events-dispatcher", daemon=True)
+        self._thread.start()
+        ready.wait()
+
+    def stop(self):
+        self._stopping.set()
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._wakeup.set)
+            self._thread.join(timeout=5)
+        self._thread = None
+        self._loop = None
+
+    def _ensure_indexes(self):
+        if self._indexes_ready:
+            return
+        outbox = database.db[OUTBOX_COLLECTION]
+        outbox.create_index([("pending", ASCENDING), ("created_at", ASCENDING), ("_id", ASCENDING)])
+        outbox.create_index("created_at", expireAfterSeconds=OUTBOX_TTL_S)
+        self._indexes_ready = True
+
+    def spool(self, key: str, event: Dict[str, Any]):
+        """Store `event` for delivery to every webhook; PyMongoError propagates"""
+        if not WEBHOOK_URLS:
+            return
+        self._ensure_indexes()
+        try:
+            database.db[OUTBOX_COLLECTION].insert_one({
+                "_id": key,
+                "event": event,
+                "pending": list(WEBHOOK_URLS),
+                "created_at": datetime.now(timezone.utc),
+            })
+            _incr("outbox_spooled")
+        except mongo_errors.DuplicateKeyError:
+            # Replayed after a restart or failover; already spooled
+            _incr("outbox_duplicates")
+
+    async def _sleep(self, seconds: float):
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), seconds)
+        except asyncio.TimeoutError:
+            pass
+
+    async def _main(self):
+        while not self._stopping.is_set():
+            for url in list(WEBHOOK_URLS):
+                if url not in self._tasks:
+                    self._tasks[url] = asyncio.ensure_future(self._deliver(url))
+            await self._sleep(LEASE_S / 3)
+        for task in self._tasks.values():
+            task.cancel()
+        await asyncio.gather(*self._tasks.values(), return_exceptions=True)
+        self._tasks.clear()
+
+    async def _deliver(self, url: str):
+        outbox = database.db[OUTBOX_COLLECTION]
+        attempt = 0
+        while not self._stopping.is_set():
+            if not await self._loop.run_in_executor(None, self._lease.refresh):
+                await self._sleep(LEASE_S / 3)
+                continue
+            try:
+                docs = await self._loop.run_in_executor(None, lambda: list(
+                    outbox.find({"pending": url}, {"event": 1})
+                    .sort([("created_at", ASCENDING), ("_id", ASCENDING)])
+                    .limit(BATCH_SIZE)
+                ))
+            except mongo_errors.PyMongoError:
+                _incr("outbox_errors")
+                await self._sleep(POLL_INTERVAL_S)
+                continue
+            if not docs:
+                await self._sleep(BATCH_WAIT_S)
+                continue
+
+            if not await self._post(url, {"events": [doc["event"] for doc in docs]}):
+                _incr("webhook_retries")
+                attempt += 1
+                await self._sleep(min(0.5 * (2 ** attempt), 30.0))
+                continue
+            attempt = 0
+
+            ids = [doc["_id"] for doc in docs]
+            try:
+                await self._loop.run_in_executor(None, lambda: (
+                    outbox.update_many({"_id": {"$in": ids}}, {"$pull": {"pending": url}}),
+                    outbox.delete_many({"_id": {"$in": ids}, "pending": []}),
+                ))
+            except mongo_errors.PyMongoError:
+                # The batch is sent again: at-least-once
+                _incr("outbox_errors")
+
+    async def _post(self, url: str, payload: Dict[str, Any]) -> bool:
+        """One delivery attempt; True once the receiver answered with a non-5xx status"""
+        try:
+            response = await self._loop.run_in_executor(
+                None, lambda: requests.post(url, json=payload, timeout=WEBHOOK_TIMEOUT_S)
+            )
+        except requests.RequestException:
+            return False
+        if response.status_code >= 500:
+            return False
+        # 4xx means the receiver rejected the batch; retrying will not help
+        _incr("webhook_batches_sent" if response.ok else "webhook_rejected")
+        return True
+
+
+# =============================================================================
+# WATCHER
+# =============================================================================
+
+class CollectionWatcher:
+    """Tails one collection and publishes its changes"""
+
+    def __init__(self, collection_name: str, dispatcher: WebhookDispatcher, worker_id: str):
+        self.collection_name = collection_name
+        self.dispatcher = dispatcher
+        self.mode = "starting"
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._lease = _Lease(f"leader:{collection_name}", worker_id)
+        self._cursor_id = f"cursor:{collection_name}"
+        # Position of the last spooled event, saved at most once per second
+        self._unsaved: Optional[Dict[str, Any]] = None
+        self._saved_at = 0.0
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name=f"events-{self.collection_name}", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+
+    @property
+    def is_leader(self) -> bool:
+        return self._lease.held
+
+    # -- resume position -------------------------------------------------------
+
+    def _load_position(self) -> Dict[str, Any]:
+        return database.db[CURSOR_COLLECTION].find_one({"_id": self._cursor_id}) or {}
+
+    def _save_position(self, position: Dict[str, Any]):
+        if not self._lease.held:
+            return
+        try:
+            database.db[CURSOR_COLLECTION].update_one(
+                {"_id": self._cursor_id},
+                {"$set": {**position, "saved_at": datetime.now(timezone.utc)}},
+                upsert=True,
+            )
+        except mongo_errors.PyMongoError:
+            _incr("cursor_save_errors")
+
+    def _checkpoint(self, position: Optional[Dict[str, Any]] = None):
+        """Record `position` as reached and persist the latest one (throttled)"""
+        if position is not None:
+            self._unsaved = position
+        if self._unsaved is not None and time.monotonic() - self._saved_at >= 1.0:
+            self._save_position(self._unsaved)
+            self._unsaved = None
+            self._saved_at = time.monotonic()
+
+    def _publish(self, operation: str, document_id: Any, key: str, position: Optional[Dict[str, Any]]):
+        """Invalidate local caches; the leader also spools the event for webhooks.
+
+        A spool failure propagates, so the position never moves past an event
+        that is not stored; the caller reopens from the saved position.
+        """
+        event = {
+            "collection": self.collection_name,
+            "operation": operation,
+            "document_id": str(document_id) if document_id is not None else None,
+            "at": datetime.now(timezone.utc).isoformat(),
+        }
+        _incr(f"events.{operation}")
+        _notify_caches(event)
+        if not self._lease.held:
+            return
+        self.dispatcher.spool(key, event)
+        if position is not None:
+            self._checkpoint(position)
+
+    # -- main loop -------------------------------------------------------------
+
+    def _run(self):
+        polling = False
+        history_lost = False
+        while not self._stop.is_set():
+            try:
+                self._lease.refresh()
+                if history_lost:
+                    self._save_position({"resume_token": None})
+                    self._publish("flush", None, f"flush:{self.collection_name}:{uuid.uuid4().hex}", None)
+                    history_lost = False
+                if polling:
+                    self._poll()
+                else:
+                    self._watch_change_stream()
+                continue
+            except mongo_errors.OperationFailure as e:
+                if e.code in _NO_CHANGE_STREAM_CODES:
+                    polling = True
+                    continue
+                if e.code in _HISTORY_LOST_CODES:
+                    history_lost = True
+                    continue
+                _incr("watch_errors")
+            except mongo_errors.PyMongoError:
+                _incr("watch_errors")
+            self._stop.wait(POLL_INTERVAL_S)
+
+    def _watch_change_stream(self):
+        """Tail the stream until stopped or until this worker becomes leader.
+
+        Returning on the leader transition makes `_run` reopen the stream from
+        the token the previous leader persisted, so changes it saw but never
+        spooled are replayed.
+        """
+        self.mode = "change_stream"
+        token = self._load_position().get("resume_token") if self._lease.held else None
+        collection = database.db[self.collection_name]
+        self._unsaved = None
+
+        with collection.watch(resume_after=token, max_await_time_ms=int(POLL_INTERVAL_S * 1000)) as stream:
+            while not self._stop.is_set():
+                change = stream.try_next()
+                if change is not None:
+                    self._publish(
+                        change["operationType"],
+                        change.get("documentKey", {}).get("_id"),
+                        str(change["_id"].get("_data", change["_id"])),
+                        {"resume_token": change["_id"]},
+                    )
+                elif stream.resume_token is not None:
+                    # Idle: everything seen is spooled, the post-batch token is safe
+                    self._checkpoint({"resume_token": stream.resume_token})
+                if self._lease.acquired():
+                    _incr("leader_acquired")
+                    return
+
+    def _poll(self):
+        """Standalone fallback: scan the (updated_at, _id) index for changed documents.
+
+        `updated_at` is stamped by the client before the insert commits, so a
+        document can become visible after newer ones. Each scan therefore
+        starts POLL_LAG_S before the newest timestamp seen and skips
+        (_id, updated_at) pairs already published. After a restart or
+        failover that window is scanned again, so recent changes may be
+        published twice (the outbox drops repeats it already holds). Deletes
+        are not observed in this mode.
+        """
+        self.mode = "polling"
+        collection = database.db[self.collection_name]
+        lag = timedelta(seconds=POLL_LAG_S)
+        ready = False
+        high: Optional[datetime] = None
+        seen: Dict[Tuple[Any, datetime], datetime] = {}
+
+        while not self._stop.is_set():
+            try:
+                acquired = self._lease.acquired()
+                if acquired:
+                    _incr("leader_acquired")
+                if not ready or acquired:
+                    # (Re)start from the last saved position, e.g. as new leader
+                    collection.create_index([("updated_at", ASCENDING), ("_id", ASCENDING)])
+                    high = self._load_position().get("poll_updated_at")
+                    seen.clear()
+                    if high is None:
+                        # First run: existing documents are not changes
+                        high = self._scan(collection, None, None, seen, publish=False)
+                    ready = True
+                high = self._scan(collection, high - lag if high else None, high, seen)
+                if high is not None:
+                    for key, at in list(seen.items()):
+                        if at < high - lag:
+                            del seen[key]
+                self._checkpoint()
+            except mongo_errors.PyMongoError:
+                _incr("poll_errors")
+            self._stop.wait(POLL_INTERVAL_S)
+
+    def _scan(
+        self, collection, since: Optional[datetime], high: Optional[datetime], seen: Dict, publish: bool = True,
+    ) -> Optional[datetime]:
+        """Page through documents with updated_at >= since; returns the new high-water mark"""
+        base: Dict[str, Any] = {"updated_at": {"$gte": since} if since else {"$type": "date"}}
+        after: Optional[Tuple[datetime, Any]] = None
+        while not self._stop.is_set():
+            query = base
+            if after is not None:
+                query = {"$and": [base, {"$or": [
+                    {"updated_at": {"$gt": after[0]}},
+                    {"updated_at": after[0], "_id": {"$gt": after[1]}},
+                ]}]}
+            docs = list(
+                collection.find(query, {"updated_at": 1, "created_at": 1})
+                .sort([("updated_at", ASCENDING), ("_id", ASCENDING)])
+                .limit(BATCH_SIZE)
+            )
+            for doc in docs:
+                at = doc["updated_at"]
+                high = at if high is None else max(high, at)
+                if (doc["_id"], at) in seen:
+                    continue
+                seen[(doc["_id"], at)] = at
+                if publish:
+                    operation = "insert" if doc.get("created_at") == at else "update"
+                    self._publish(operation, doc["_id"], f"{doc['_id']}:{at.isoformat()}", {"poll_updated_at": high})
+            if len(docs) < BATCH_SIZE:
+                break
+            after = (docs[-1]["updated_at"], docs[-1]["_id"])
+        return high
+
+
+# =============================================================================
+# LIFECYCLE
+# =============================================================================
+
+_worker_id = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+_dispatcher = WebhookDispatcher(_worker_id)
+_watchers: List[CollectionWatcher] = []
+
+
+def start():
+    """Start the dispatcher and one watcher per watched collection"""
+    if database.db is None or _watchers:
+        return
+    _dispatcher.start()
+    for name in WATCHED_COLLECTIONS:
+        watcher = CollectionWatcher(name, _dispatcher, _worker_id)
+        watcher.start()
+        _watchers.append(watcher)
+
+
+def stop():
+    for watcher in _watchers:
+        watcher.stop()
+    _watchers.clear()
+    _dispatcher.stop()
+
+
+def status() -> Dict[str, Any]:
+    with _stats_lock:
+        counters = dict(_stats)
+    with _caches_lock:
+        caches = sorted(_caches)
+    return {
+        "worker_id": _worker_id,
+        "watchers": {w.collection_name: {"mode": w.mode, "leader": w.is_leader} for w in _watchers},
+        "caches": caches,
+        "webhooks": len(WEBHOOK_URLS),
+        "outbox_leader": _dispatcher.is_leader,
+        "counters": counters,
+    }
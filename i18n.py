@@ -0,0 +1,153 @@
+"""
+Plan Localisation
+
+Message catalogues in `locales/<locale>.json`. The planner asks `translator`
+for a locale's `t(key, **params)` and gets final strings straight from the
+compiled table; there is no per-section rendering pass or cache.
+
+Catalogues are compiled once at import into per-locale string tables: keys and
+literal fragments are interned, parameter-free messages are stored as the
+final string, and keys missing from a locale reuse the default locale's
+objects, so every extra locale only costs the memory of its own translations.
+"""
+
+import json
+import os
+import sys
+from string import Formatter
+from typing import Any, Callable, Dict, List, Optional, Tuple, Union
+
+LOCALES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "locales")
+DEFAULT_LOCALE = "pt"
+SUPPORTED_LOCALES = tuple(
+    l for l in os.getenv("PLAN_LOCALES", "pt,es,en").split(",") if l
+)
+# Upper bound for one compiled catalogue; startup fails if a locale exceeds it
+CATALOG_MAX_BYTES = int(os.getenv("PLAN_CATALOG_MAX_BYTES", 256 * 1024))
+
+
+# A compiled message is either the final string or a tuple of
+# literal fragments (str) and parameter names (1-tuples)
+Compiled = Union[str, Tuple[Union[str, Tuple[str]], ...]]
+
+
+def _compile_template(locale: str, key: str, template: str) -> Compiled:
+    parts: List[Union[str, Tuple[str]]] = []
+    for literal, field, spec, conversion in Formatter().parse(template):
+        if literal:
+            parts.append(sys.intern(literal))
+        if field is not None:
+            if not field or spec or conversion:
+                raise ValueError(f"{locale}:{key}: only plain {{name}} fields are supported")
+            parts.append((sys.intern(field),))
+    if all(isinstance(p, str) for p in parts):
+        return sys.intern("".join(parts))
+    return tuple(parts)
+
+
+def _sizeof(obj: Any, seen: set) -> int:
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(_sizeof(k, seen) + _sizeof(v, seen) for k, v in obj.items())
+    elif isinstance(obj, tuple):
+        size += sum(_sizeof(item, seen) for item in obj)
+    return size
+
+
+def _load_catalogs() -> Tuple[Dict[str, Dict[str, Compiled]], Dict[str, int]]:
+    tables: Dict[str, Dict[str, Compiled]] = {}
+    sizes: Dict[str, int] = {}
+
+    # Objects reachable from the default table are shared, so they are
+    # excluded when measuring the other locales
+    shared: set = set()
+    for locale in (DEFAULT_LOCALE,) + tuple(l for l in SUPPORTED_LOCALES if l != DEFAULT_LOCALE):
+        with open(os.path.join(LOCALES_DIR, f"{locale}.json"), encoding="utf-8") as fh:
+            raw = json.load(fh)
+
+        table: Dict[str, Compiled] = {}
+        base = tables.get(DEFAULT_LOCALE, {})
+        for key, template in raw.items():
+            compiled = _compile_template(locale, key, template)
+            # Identical translation: reuse the default locale's object
+            if base.get(key) == compiled:
+                compiled = base[key]
+            table[sys.intern(key)] = compiled
+        for key, compiled in base.items():
+            table.setdefault(key, compiled)
+
+        seen = set(shared)
+        sizes[locale] = _sizeof(table, seen)
+        if sizes[locale] > CATALOG_MAX_BYTES:
+            raise ValueError(
+                f"catalogue '{locale}' uses {sizes[locale]} bytes (limit {CATALOG_MAX_BYTES})"
+            )
+        if locale == DEFAULT_LOCALE:
+            shared = seen - {id(table)}
+        tables[locale] = table
+
+    return tables, sizes
+
+
+_tables, _catalog_bytes = _load_catalogs()
+
+
+# =============================================================================
+# NEGOTIATION AND RENDERING
+# =============================================================================
+
+def negotiate_locale(accept_language: Optional[str]) -> str:
+    """Pick the best supported locale from an Accept-Language header"""
+    if not accept_language:
+        return DEFAULT_LOCALE
+    candidates = []
+    for position, item in enumerate(accept_language.split(",")):
+        tag, _, params = item.strip().partition(";")
+        quality = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        if quality > 0:
+            candidates.append((-quality, position, tag.strip().lower()))
+    for _, _, tag in sorted(candidates):
+        primary = tag.split("-")[0]
+        if primary in _tables:
+            return primary
+        if primary == "*":
+            return DEFAULT_LOCALE
+    return DEFAULT_LOCALE
+
+
+def translator(locale: str) -> Callable[..., str]:
+    """`t(key, **params)` for `locale`: the message text from the compiled table.
+
+    Unknown locales fall back to the default one and unknown keys render as
+    the key itself. Missing parameters render as "".
+    """
+    table = _tables.get(locale) or _tables[DEFAULT_LOCALE]
+
+    def t(key: str, **params) -> str:
+        compiled = table.get(key)
+        if compiled is None:
+            return key
+        if type(compiled) is str:
+            return compiled
+        return "".join([p if type(p) is str else str(params.get(p[0], "")) for p in compiled])
+
+    return t
+
+
+def i18n_stats() -> Dict[str, Any]:
+    return {
+        "default": DEFAULT_LOCALE,
+        "locales": {
+            locale: {"messages": len(table), "catalog_bytes": _catalog_bytes[locale]}
+            for locale, table in _tables.items()
+        },
+    }
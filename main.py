@@ -1,11 +1,27 @@
 import os
-from fastapi import FastAPI, HTTPException
+import json
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from fastapi import FastAPI, Header, HTTPException, Response
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
-from typing import Dict, Any
+from fastapi.responses import StreamingResponse
+from starlette.background import BackgroundTask
+from pydantic import BaseModel, Field
+from typing import Dict, Any, List, Optional
 
-from database import db, create_document
-from schemas import Questionnaire, Assessment
+from bson import ObjectId
+from bson.errors import InvalidId
+
+import events
+from database import db
+from persistence import persist_document, persistence_stats, PersistenceError
+from i18n import negotiate_locale, i18n_stats
+from planner import build_plan, build_plans, iter_plan_sections
+from pymongo.errors import PyMongoError
+from progress import ingest_logs, progress_overview, InvalidAssessmentId, AssessmentNotFound
+from schemas import Questionnaire, Assessment, WorkoutLog
 
 app = FastAPI(title="Premium Personal Trainer API")
 
@@ -17,6 +33,14 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+@app.on_event("startup")
+def start_events():
+    events.start()
+
+@app.on_event("shutdown")
+def stop_events():
+    events.stop()
+
 @app.get("/")
 def read_root():
     return {"message": "Trainer API running"}
@@ -37,227 +61,274 @@ def test_database():
         response["database"] = f"error: {str(e)[:80]}"
     return response
 
+@app.get("/metrics/persistence")
+def persistence_metrics():
+    """Persistence counters (retries, error classes, dead letters) and breaker state"""
+    return persistence_stats()
+
+@app.get("/events/status")
+def events_status():
+    """Change-event watcher mode, leadership, registered caches and counters"""
+    return events.status()
+
+@app.get("/i18n/status")
+def locale_status():
+    """Compiled catalogue sizes per locale"""
+    return i18n_stats()
+
 class GenerateRequest(BaseModel):
     questionnaire: Questionnaire
 
+class GenerateBatchRequest(BaseModel):
+    questionnaires: List[Questionnaire] = Field(..., min_length=1, max_length=500)
+
+def persist_assessment(
+    q: Questionnaire, resposta: Dict[str, Any], locale: str, assessment_id: Optional[ObjectId] = None,
+) -> Optional[str]:
+    """Persistir avaliação; falhas ficam nas métricas e no dead-letter e o plano é devolvido mesmo assim.
+
+    Com `assessment_id` fixo a gravação é idempotente: repetir grava uma vez só.
+    """
+    try:
+        doc = Assessment(questionnaire=q, plan=resposta, locale=locale)
+        if assessment_id is not None:
+            doc = {**doc.model_dump(), "_id": assessment_id}
+        return persist_document("assessment", doc)
+    except PersistenceError:
+        return None
+
 @app.post("/generate")
-def generate_plan(payload: GenerateRequest) -> Dict[str, Any]:
+def generate_plan(
+    payload: GenerateRequest,
+    response: Response,
+    accept_language: Optional[str] = Header(None),
+) -> Dict[str, Any]:
     q = payload.questionnaire
+    locale = negotiate_locale(accept_language)
+    response.headers["Content-Language"] = locale
+    resposta = build_plan(q, locale)
 
-    # Helper flags
-    objetivo = q.objetivo
-    nivel = q.nivel
-    tem_dor_joelho = any("joelho" in d.lower() for d in (q.lesoes + q.dores))
-    tem_dor_coluna = any(x in d.lower() for d in (q.lesoes + q.dores) for x in ["coluna", "lombar", "costas"])
-    equipamentos = set(e.lower() for e in q.equipamentos)
-
-    # Define frequência e duração
-    freq = q.sessoes_semana
-    dur = min(max(q.tempo_por_sessao_min, 25), 75)
-
-    # Estilo base
-    if q.estilo_preferido:
-        estilo = q.estilo_preferido
-    else:
-        estilo = "full body" if nivel in ["iniciante", "intermediario"] else "upper/lower"
-
-    # Foco do plano
-    if objetivo == "emagrecimento":
-        foco = "déficit calórico + alta densidade de treino"
-        cardio_final = True
-    elif objetivo == "ganho de massa":
-        foco = "sobrecarga progressiva com técnica limpa"
-        cardio_final = False
-    elif objetivo == "recomposicao":
-        foco = "mescla de força + cardio moderado"
-        cardio_final = True
-    else:
-        foco = "condicionamento geral com segurança articular"
-        cardio_final = True
-
-    # Construção do treino da Semana 1
-    def adapt_exec(nome, series_reps, execucao, ajustes=None):
-        item = {
-            "nome": nome,
-            "series_reps": series_reps,
-            "execucao": execucao[:300]
-        }
-        if ajustes:
-            item["ajuste"] = ajustes
-        return item
-
-    aquecimento = [
-        {
-            "exercicio": "Mobilidade torácica e quadril",
-            "tempo": "2 min",
-            "descricao": "círculos de ombro, gato-vaca, abertura de quadril",
-            "adaptacao": "sem dor; reduzir amplitude se coluna reclamar" if tem_dor_coluna else ""
-        },
-        {
-            "exercicio": "Ativação glúteo + core",
-            "tempo": "2 min",
-            "descricao": "ponte de glúteo + pranchas curtas (15–20s)",
-            "adaptacao": "apoio de joelho em superfícies macias" if tem_dor_joelho else ""
-        }
-    ]
-
-    # Escolha de exercícios conforme equipamentos
-    def tem(eq):
-        return any(eq in e for e in equipamentos)
-
-    principais = []
-
-    # Exercício 1
-    if tem("halter") or tem("dumbbell"):
-        principais.append(adapt_exec(
-            "Agachamento goblet",
-            "3 x 8–12",
-            "segurar halter ao peito, descer até amplitude confortável, coluna neutra",
-            "trocar por cadeira extensora ou agachamento em caixa se joelho doer" if tem_dor_joelho else None
-        ))
-    elif tem("barra") or tem("smith"):
-        principais.append(adapt_exec(
-            "Agachamento no smith (box squat)",
-            "3 x 8–10",
-            "sentar em caixa/banquinho para limitar amplitude e manter controle",
-            "altura da caixa reduz dor no joelho" if tem_dor_joelho else None
-        ))
-    else:
-        principais.append(adapt_exec(
-            "Agachamento com peso corporal",
-            "4 x 12–15",
-            "pés estáveis, tronco firme; pausa de 1s no fundo",
-            "usar apoio em porta ou cadeira se houver dor no joelho"
-        ))
-
-    # Exercício 2
-    if tem("maquina") or tem("remada") or tem("cabo"):
-        principais.append(adapt_exec(
-            "Remada sentada na máquina/cabo",
-            "3 x 10–12",
-            "peito aberto, puxar cotovelos para trás, segurar 1s",
-            "trocar por remada com halteres apoiado no banco se coluna sensível" if tem_dor_coluna else None
-        ))
-    else:
-        principais.append(adapt_exec(
-            "Remada curvada com halteres",
-            "3 x 8–10",
-            "tronco inclinado 30–45°, core ativo, movimentos controlados",
-            "apoiar o peito no banco para poupar lombar" if tem_dor_coluna else None
-        ))
-
-    # Exercício 3
-    if tem("supino") or tem("banco") or tem("halter"):
-        principais.append(adapt_exec(
-            "Supino com halteres (banco)",
-            "3 x 8–12",
-            "punhos neutros, linha do peito, pés firmes",
-            None
-        ))
-    else:
-        principais.append(adapt_exec(
-            "Flexões inclinadas (apoio na mesa/parede)",
-            "4 x 8–12",
-            "corpo alinhado, amplitude confortável",
-            "aumentar inclinação se punho/ombro reclamar"
-        ))
-
-    # Exercício 4 (opcional) conforme objetivo
-    if objetivo in ["emagrecimento", "recomposicao"]:
-        if tem("kettlebell"):
-            principais.append(adapt_exec(
-                "Kettlebell swing",
-                "4 x 15–20",
-                "quadril domina o movimento, costas firmes, não elevar além dos ombros",
-                "trocar por levantamento terra romeno leve com halteres se lombar sensível" if tem_dor_coluna else None
-            ))
-        else:
-            principais.append(adapt_exec(
-                "Levantamento terra romeno (halteres)",
-                "3 x 10–12",
-                "deslizar halteres nas coxas, quadril para trás, coluna neutra",
-                "diminuir amplitude se lombar sinalizar"
-            ))
-
-    finalizacao = None
-    if cardio_final:
-        cardio_tipo = q.cardio_preferido or "caminhada"
-        finalizacao = {
-            "tipo": cardio_tipo,
-            "tempo": 8 if objetivo == "ganho de massa" else 12,
-            "intensidade": "RPE 6/10 (respiração acelerada, conversa ainda possível)",
-            "observacoes": "mantém gasto calórico sem atrapalhar recuperação" if objetivo != "ganho de massa" else "apenas para condicionamento"
-        }
-
-    # Resumo do aluno
-    resumo = {
-        "objetivo": objetivo,
-        "nivel": nivel,
-        "lesoes_limitacoes": q.lesoes + q.dores,
-        "rotina_tempo": f"{freq}x por semana, {dur} min por sessão",
-        "estilo": estilo,
-        "equipamentos": list(equipamentos) or ["peso corporal"],
-    }
+    assessment_id = persist_assessment(q, resposta, locale)
+    if assessment_id:
+        resposta["assessment_id"] = assessment_id
 
-    # Estratégia
-    estrategia = {
-        "foco": foco,
-        "estilo": estilo,
-        "intensidade_inicial": "moderada, técnica em primeiro lugar",
-        "frequencia": f"{freq}x/semana",
-        "duracao": f"{dur} min/sessão",
-        "cuidados": [
-            "reduzir amplitude em movimentos que irritem joelho" if tem_dor_joelho else "",
-            "priorizar estabilidade de core para proteger coluna" if tem_dor_coluna else ""
-        ],
-        "justificativa": "plano direto e eficiente, alinhado ao objetivo e ao equipamento disponível"
-    }
+    return resposta
 
-    plano_semana1 = {
-        "aquecimento": aquecimento,
-        "principais": principais[:4],
-        "finalizacao": finalizacao
-    }
+@app.post("/generate/batch")
+def generate_plans_batch(
+    payload: GenerateBatchRequest,
+    response: Response,
+    accept_language: Optional[str] = Header(None),
+) -> Dict[str, Any]:
+    """Plans for many questionnaires (bulk re-planning); prescriptions are vectorised"""
+    locale = negotiate_locale(accept_language)
+    response.headers["Content-Language"] = locale
+    planos = build_plans(payload.questionnaires, locale)
 
-    recomendacoes = [
-        "Proteína: 1.6–2.2 g/kg/dia, dividir em 3–4 refeições",
-        "Creatina 3–5 g/dia se não houver contraindicação",
-        "Dormir 7–8h; se não for possível, reduzir 1 série por exercício",
-        "Intervalos de 60–90s entre séries (até 120s em compostos)",
-        "Use gatilhos: horário fixo e check rápido pós-treino para reforço"
-    ]
-
-    progresso_4s = [
-        "Semana 1: consolidar técnica; ajustar cargas para RPE 7/10 no final",
-        "Semana 2: aumentar carga ou reps (+2) mantendo forma",
-        "Semana 3: trocar 1 variação por mais desafiadora (ex: banco plano -> inclinado)",
-        "Semana 4: incluir 1 sessão com HIIT leve (6x30s) se articulações estiverem bem; reavaliar medidas"
-    ]
-
-    avisos = [
-        "Dor articular aguda = parar, reduzir amplitude/carga ou trocar a variação",
-        "Coluna: sempre neutra; se houver desconforto, use apoios e isometrias",
-        "Joelho: não travar; use caixa/apoio para controlar amplitude",
-        "Progresso depende de consistência: 3–4x/semana por 4+ semanas",
-    ]
-
-    resposta = {
-        "resumo": resumo,
-        "estrategia": estrategia,
-        "semana1": plano_semana1,
-        "recomendacoes": recomendacoes,
-        "progresso": progresso_4s,
-        "avisos": avisos
-    }
+    for q, resposta in zip(payload.questionnaires, planos):
+        assessment_id = persist_assessment(q, resposta, locale)
+        if assessment_id:
+            resposta["assessment_id"] = assessment_id
+
+    return {"planos": planos}
+
+
+# Reconnect delay suggested to EventSource clients
+SSE_RETRY_MS = int(os.getenv("SSE_RETRY_MS", 3000))
+STREAM_TICKET_TTL_S = int(os.getenv("STREAM_TICKET_TTL_S", 600))
+
+def _sse(event: str, data: Any, event_id: str) -> str:
+    return f"id: {event_id}\nevent: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+class _PlanStream:
+    """Sections of one streamed plan, shared by the SSE body and its background task.
+
+    The body persists when the client reads to the end (so `fim` can carry the
+    assessment_id). If the client disconnects first, Starlette stops the body
+    but still runs the background task, which computes the remaining sections
+    and persists the full plan. The lock keeps both from advancing the
+    generator at once.
+    """
+
+    def __init__(self, q: Questionnaire, locale: str, assessment_id: Optional[ObjectId] = None):
+        self.q = q
+        self.locale = locale
+        self.assessment_id = assessment_id
+        self.resposta: Dict[str, Any] = {}
+        self._sections = iter_plan_sections(q, locale)
+        self._lock = threading.Lock()
+        self._failed = False
+        self._persisted = False
+        self._assessment_id: Optional[str] = None
+
+    def next_section(self):
+        with self._lock:
+            try:
+                for section, content in self._sections:
+                    self.resposta[section] = content
+                    return section, content
+            except Exception:
+                self._failed = True
+                raise
+            return None
 
-    # Persistir avaliação
+    def persist(self) -> Optional[str]:
+        with self._lock:
+            if self._persisted or self._failed:
+                return self._assessment_id
+            for section, content in self._sections:
+                self.resposta[section] = content
+            self._assessment_id = persist_assessment(self.q, self.resposta, self.locale, self.assessment_id)
+            self._persisted = True
+            return self._assessment_id
+
+    def events(self, last_event_id: Optional[str] = None):
+        """One SSE event per plan section as it is computed; persistence happens at the end.
+
+        Events are numbered by section; a reconnect that sends `Last-Event-ID`
+        only receives the sections after it (all are still computed).
+        """
+        skip = int(last_event_id) if last_event_id and last_event_id.isdigit() else 0
+        yield f"retry: {SSE_RETRY_MS}\n\n"
+        number = 0
+        while True:
+            item = self.next_section()
+            if item is None:
+                break
+            number += 1
+            if number > skip:
+                yield _sse(*item, event_id=str(number))
+        yield _sse("fim", {"assessment_id": self.persist()}, event_id="fim")
+
+def _sse_response(
+    q: Questionnaire,
+    accept_language: Optional[str],
+    assessment_id: Optional[ObjectId] = None,
+    last_event_id: Optional[str] = None,
+) -> StreamingResponse:
+    locale = negotiate_locale(accept_language)
+    stream = _PlanStream(q, locale, assessment_id)
+    return StreamingResponse(
+        stream.events(last_event_id),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no", "Content-Language": locale},
+        background=BackgroundTask(stream.persist),
+    )
+
+class _StreamTickets:
+    """Questionnaires parked for GET /generate/stream/{ticket}.
+
+    Stored in Mongo with a TTL index so any worker can serve the GET; kept in
+    process when no database is configured. A ticket stays valid until it
+    expires, so EventSource reconnects can reuse it.
+    """
+
+    COLLECTION = "stream_ticket"
+    MAX_LOCAL = 10000
+
+    def __init__(self):
+        self._local: "OrderedDict[str, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._indexes_ready = False
+
+    def put(self, q: Questionnaire) -> str:
+        ticket = ObjectId()
+        if db is None:
+            with self._lock:
+                self._local[str(ticket)] = (time.monotonic(), q)
+                while len(self._local) > self.MAX_LOCAL:
+                    self._local.popitem(last=False)
+            return str(ticket)
+        if not self._indexes_ready:
+            db[self.COLLECTION].create_index("created_at", expireAfterSeconds=STREAM_TICKET_TTL_S)
+            self._indexes_ready = True
+        db[self.COLLECTION].insert_one({
+            "_id": ticket,
+            "questionnaire": q.model_dump(mode="json"),
+            "created_at": datetime.now(timezone.utc),
+        })
+        return str(ticket)
+
+    def get(self, ticket: ObjectId) -> Optional[Questionnaire]:
+        if db is None:
+            with self._lock:
+                created, q = self._local.get(str(ticket), (0.0, None))
+            return q if time.monotonic() - created < STREAM_TICKET_TTL_S else None
+        # The TTL monitor only runs every minute or so; check expiry here too
+        cutoff = datetime.now(timezone.utc) - timedelta(seconds=STREAM_TICKET_TTL_S)
+        doc = db[self.COLLECTION].find_one({"_id": ticket, "created_at": {"$gt": cutoff}})
+        return Questionnaire.model_validate(doc["questionnaire"]) if doc else None
+
+_stream_tickets = _StreamTickets()
+
+@app.post("/generate/stream")
+def generate_plan_stream(payload: GenerateRequest, accept_language: Optional[str] = Header(None)):
+    return _sse_response(payload.questionnaire, accept_language)
+
+@app.post("/generate/stream/ticket")
+def create_stream_ticket(payload: GenerateRequest) -> Dict[str, Any]:
+    """Step 1 for EventSource clients: park the questionnaire (kept out of URLs and access logs)"""
     try:
-        doc = Assessment(questionnaire=q, plan=resposta)
-        create_document("assessment", doc)
-    except Exception:
-        pass
+        ticket = _stream_tickets.put(payload.questionnaire)
+    except PyMongoError as e:
+        raise HTTPException(status_code=503, detail=f"ticket storage unavailable: {str(e)[:80]}")
+    return {"ticket": ticket, "stream_url": f"/generate/stream/{ticket}", "expires_in_s": STREAM_TICKET_TTL_S}
 
-    return resposta
+@app.get("/generate/stream/{ticket}")
+def generate_plan_stream_get(
+    ticket: str,
+    accept_language: Optional[str] = Header(None),
+    last_event_id: Optional[str] = Header(None),
+):
+    """Step 2: EventSource stream for a ticket. Clients must close() on the `fim` event.
+
+    The ticket is also the assessment's `_id`, so the plan is stored once no
+    matter how often the client reconnects, and `fim` always carries that id.
+    """
+    try:
+        assessment_id = ObjectId(ticket)
+    except InvalidId:
+        raise HTTPException(status_code=422, detail=f"invalid ticket: {ticket}")
+    try:
+        q = _stream_tickets.get(assessment_id)
+    except PyMongoError as e:
+        raise HTTPException(status_code=503, detail=f"ticket storage unavailable: {str(e)[:80]}")
+    if q is None:
+        raise HTTPException(status_code=404, detail="ticket not found or expired")
+    return _sse_response(q, accept_language, assessment_id, last_event_id)
+
+
+class LogBatch(BaseModel):
+    logs: List[WorkoutLog] = Field(..., min_length=1, max_length=1000)
+
+@app.post("/progress/logs")
+def log_progress(payload: LogBatch) -> Dict[str, Any]:
+    """Registra séries executadas; agregadas em buckets semanais por avaliação"""
+    if db is None:
+        raise HTTPException(status_code=503, detail="progress storage unavailable: database not configured")
+    try:
+        return ingest_logs(payload.logs)
+    except InvalidAssessmentId as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    except AssessmentNotFound as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except PyMongoError as e:
+        raise HTTPException(status_code=503, detail=f"progress storage unavailable: {str(e)[:80]}")
+
+@app.get("/progress/{assessment_id}/weekly")
+def get_weekly_progress(assessment_id: str, semanas: int = 12) -> Dict[str, Any]:
+    """Volume e aderência por semana, lidos direto dos buckets"""
+    semanas = min(max(semanas, 1), 104)
+    if db is None:
+        raise HTTPException(status_code=503, detail="progress storage unavailable: database not configured")
+    try:
+        return progress_overview(assessment_id, semanas)
+    except InvalidAssessmentId as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    except AssessmentNotFound as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except PyMongoError as e:
+        raise HTTPException(status_code=503, detail=f"progress storage unavailable: {str(e)[:80]}")
 
 
 if __name__ == "__main__":
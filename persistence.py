@@ -0,0 +1,436 @@
+"""
+Persistence Helpers
+
+Resilient wrapper around `create_document` used by the API endpoints.
+Failures are classified as transient or permanent, transient failures are
+retried with jittered exponential backoff under a shared retry budget, and a
+circuit breaker stops new attempts while MongoDB is degraded. Every attempt runs
+under a deadline and the number of writes in flight is capped, so a hung
+server cannot pin request threads while the breaker is still counting. Documents that
+could not be written are appended to a local dead-letter file (NDJSON) that
+can be replayed later with `python persistence.py replay`.
+"""
+
+import fcntl
+import json
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from typing import Any, Dict, Optional, Union
+
+from bson import ObjectId
+from bson.errors import InvalidId
+from pydantic import BaseModel
+import pymongo
+from pymongo import errors as mongo_errors
+
+import database
+from database import create_document
+
+RETRY_MAX_ATTEMPTS = int(os.getenv("PERSIST_RETRY_MAX_ATTEMPTS", 3))
+RETRY_BASE_DELAY_S = float(os.getenv("PERSIST_RETRY_BASE_DELAY_S", 0.05))
+RETRY_MAX_DELAY_S = float(os.getenv("PERSIST_RETRY_MAX_DELAY_S", 1.0))
+# Retries allowed per first attempt (0.2 -> at most one retry for every five writes)
+RETRY_BUDGET_RATIO = float(os.getenv("PERSIST_RETRY_BUDGET_RATIO", 0.2))
+RETRY_BUDGET_MIN = int(os.getenv("PERSIST_RETRY_BUDGET_MIN", 10))
+BREAKER_FAILURE_THRESHOLD = int(os.getenv("PERSIST_BREAKER_FAILURES", 5))
+BREAKER_RESET_TIMEOUT_S = float(os.getenv("PERSIST_BREAKER_RESET_S", 30.0))
+# Deadline for one insert attempt, server selection included
+WRITE_TIMEOUT_S = float(os.getenv("PERSIST_WRITE_TIMEOUT_S", 2.0))
+# Writes allowed in flight at once; beyond this, requests fail fast
+MAX_IN_FLIGHT = int(os.getenv("PERSIST_MAX_IN_FLIGHT", 32))
+DEAD_LETTER_PATH = os.getenv("PERSIST_DEAD_LETTER_PATH", os.path.join("logs", "dead_letter.ndjson"))
+
+
+# Failures worth retrying: network blips, pool exhaustion, throttling, elections
+TRANSIENT_ERRORS = (
+    mongo_errors.AutoReconnect,          # includes NotPrimaryError
+    mongo_errors.NetworkTimeout,
+    mongo_errors.ConnectionFailure,      # includes ServerSelectionTimeoutError
+    mongo_errors.WaitQueueTimeoutError,  # connection pool exhausted
+    mongo_errors.WTimeoutError,
+    mongo_errors.ExecutionTimeout,
+)
+
+# Server error codes that signal throttling or a retryable condition
+TRANSIENT_CODES = {
+    6,      # HostUnreachable
+    7,      # HostNotFound
+    89,     # NetworkTimeout
+    91,     # ShutdownInProgress
+    189,    # PrimarySteppedDown
+    262,    # ExceededTimeLimit
+    9001,   # SocketException
+    10107,  # NotWritablePrimary
+    11600,  # InterruptedAtShutdown
+    11602,  # InterruptedDueToReplStateChange
+    13435,  # NotPrimaryNoSecondaryOk
+    16500,  # Request rate is large (throttled)
+}
+
+
+class PersistenceError(Exception):
+    """Raised when a document could not be persisted"""
+
+    def __init__(self, message: str, kind: str):
+        super().__init__(message)
+        self.kind = kind
+
+
+def classify_error(exc: Exception) -> str:
+    """Return 'transient' or 'permanent' for a persistence failure"""
+    if isinstance(exc, TRANSIENT_ERRORS):
+        return "transient"
+    if isinstance(exc, mongo_errors.PyMongoError):
+        if exc.has_error_label("RetryableWriteError"):
+            return "transient"
+        code = getattr(exc, "code", None)
+        if code in TRANSIENT_CODES:
+            return "transient"
+    if isinstance(exc, TimeoutError):
+        return "transient"
+    return "permanent"
+
+
+# =============================================================================
+# METRICS
+# =============================================================================
+
+class PersistenceMetrics:
+    """Thread-safe counters exported by GET /metrics/persistence"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters: Dict[str, int] = {}
+
+    def incr(self, name: str, amount: int = 1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + amount
+
+    def snapshot(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self._counters)
+
+
+metrics = PersistenceMetrics()
+
+
+# =============================================================================
+# RETRY BUDGET AND CIRCUIT BREAKER
+# =============================================================================
+
+class RetryBudget:
+    """Token bucket that caps retries to a fraction of first attempts"""
+
+    def __init__(self, ratio: float, minimum: int):
+        self.ratio = ratio
+        self.capacity = float(max(minimum, 1))
+        self._tokens = self.capacity
+        self._lock = threading.Lock()
+
+    def deposit(self):
+        with self._lock:
+            self._tokens = min(self.capacity, self._tokens + self.ratio)
+
+    def withdraw(self) -> bool:
+        with self._lock:
+            if self._tokens >= 1.0:
+                self._tokens -= 1.0
+                return True
+            return False
+
+
+class CircuitBreaker:
+    """Closed -> open after consecutive failures; half-open lets one probe through"""
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold: int, reset_timeout_s: float):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout_s = reset_timeout_s
+        self._state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probe_in_flight = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            return self._state
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self._state == self.CLOSED:
+                return True
+            if self._state == self.OPEN and time.monotonic() - self._opened_at >= self.reset_timeout_s:
+                self._state = self.HALF_OPEN
+                self._probe_in_flight = False
+            if self._state == self.HALF_OPEN and not self._probe_in_flight:
+                self._probe_in_flight = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self._state = self.CLOSED
+            self._failures = 0
+            self._probe_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._state == self.HALF_OPEN or self._failures >= self.failure_threshold:
+                if self._state != self.OPEN:
+                    metrics.incr("breaker_opened")
+                self._state = self.OPEN
+                self._opened_at = time.monotonic()
+                self._probe_in_flight = False
+
+
+retry_budget = RetryBudget(RETRY_BUDGET_RATIO, RETRY_BUDGET_MIN)
+breaker = CircuitBreaker(BREAKER_FAILURE_THRESHOLD, BREAKER_RESET_TIMEOUT_S)
+_in_flight = threading.BoundedSemaphore(MAX_IN_FLIGHT)
+
+
+def _backoff_delay(attempt: int) -> float:
+    """Full-jitter exponential backoff for the given retry number (1-based)"""
+    cap = min(RETRY_MAX_DELAY_S, RETRY_BASE_DELAY_S * (2 ** (attempt - 1)))
+    return random.uniform(0, cap)
+
+
+# =============================================================================
+# DEAD LETTER
+# =============================================================================
+
+_dead_letter_lock = threading.Lock()
+
+
+@contextmanager
+def _append_lock(path: str):
+    """Exclusive right to open `path` for appending, or to move it away.
+
+    Taken by the server for every dead-letter write and by replay around the
+    rename, in-process (threads) and across processes (flock on `*.lock`), so
+    no writer can still hold a handle to a file that replay has picked up.
+    """
+    with _dead_letter_lock, open(path + ".lock", "a") as lock_fh:
+        fcntl.flock(lock_fh, fcntl.LOCK_EX)
+        yield
+
+
+def _to_json_dict(data: Union[BaseModel, dict]) -> Dict[str, Any]:
+    if isinstance(data, BaseModel):
+        return data.model_dump(mode="json")
+    return json.loads(json.dumps(data, default=str))
+
+
+def _with_id(data: Union[BaseModel, dict]) -> Dict[str, Any]:
+    """Plain dict with a client-side `_id`, fixed before the first attempt.
+
+    Timeouts and reconnects are ambiguous (the write may have committed), so
+    every retry and every dead-letter replay reuses the same `_id` and a
+    duplicate-key error on it means the document is already stored.
+    """
+    doc = data.model_dump() if isinstance(data, BaseModel) else dict(data)
+    doc.setdefault("_id", ObjectId())
+    return doc
+
+
+def _is_duplicate_id(exc: Exception) -> bool:
+    if not isinstance(exc, mongo_errors.DuplicateKeyError):
+        return False
+    key_pattern = (exc.details or {}).get("keyPattern")
+    if key_pattern is not None:
+        return list(key_pattern) == ["_id"]
+    return "_id_" in str(exc)
+
+
+def _insert_once(collection_name: str, doc: Dict[str, Any]) -> str:
+    """Insert `doc` (which carries its `_id`); an existing copy counts as success"""
+    try:
+        with pymongo.timeout(WRITE_TIMEOUT_S):
+            return create_document(collection_name, doc)
+    except mongo_errors.DuplicateKeyError as e:
+        if not _is_duplicate_id(e):
+            raise
+        metrics.incr("duplicate_id_ignored")
+        return str(doc["_id"])
+
+
+def write_dead_letter(collection_name: str, data: Union[BaseModel, dict], exc: Exception, kind: str):
+    """Append a failed document to the dead-letter file"""
+    data_json = _to_json_dict(data)
+    record = {
+        "collection": collection_name,
+        "document_id": str(data_json.pop("_id")) if "_id" in data_json else None,
+        "data": data_json,
+        "error": f"{type(exc).__name__}: {str(exc)[:200]}",
+        "kind": kind,
+        "failed_at": datetime.now(timezone.utc).isoformat(),
+    }
+    line = json.dumps(record, ensure_ascii=False)
+    try:
+        directory = os.path.dirname(DEAD_LETTER_PATH)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with _append_lock(DEAD_LETTER_PATH), open(DEAD_LETTER_PATH, "a", encoding="utf-8") as fh:
+            fh.write(line + "\n")
+        metrics.incr("dead_lettered")
+    except OSError:
+        metrics.incr("dead_letter_write_failed")
+
+
+def _replay_record(record: Dict[str, Any]):
+    doc = dict(record["data"])
+    if record.get("document_id"):
+        try:
+            doc["_id"] = ObjectId(record["document_id"])
+        except InvalidId:
+            doc["_id"] = record["document_id"]
+    _insert_once(record["collection"], doc)
+
+
+def replay_dead_letters(path: Optional[str] = None) -> Dict[str, int]:
+    """Re-insert dead-lettered documents; entries that fail again are kept.
+
+    Safe to run from another process while the server is appending: the file
+    is renamed to `*.replaying` under the same lock the server takes to append
+    (so it starts a fresh file and never writes to the renamed one), and a
+    `*.replay.lock` flock keeps concurrent replays apart. A replay interrupted midway
+    leaves `*.replaying` behind and the next run picks it up; documents it
+    already inserted are recognised by their `_id`.
+    """
+    path = path or DEAD_LETTER_PATH
+    replaying_path = path + ".replaying"
+
+    with open(path + ".replay.lock", "a") as replay_lock_fh:
+        fcntl.flock(replay_lock_fh, fcntl.LOCK_EX)
+        with _append_lock(path):
+            if os.path.exists(path):
+                if os.path.exists(replaying_path):
+                    # Leftover from an interrupted replay: fold the new entries into it
+                    with open(path, "r", encoding="utf-8") as src, open(replaying_path, "a", encoding="utf-8") as dst:
+                        dst.write(src.read())
+                    os.remove(path)
+                else:
+                    os.replace(path, replaying_path)
+        if not os.path.exists(replaying_path):
+            return {"replayed": 0, "remaining": 0, "undecodable": 0}
+
+        with open(replaying_path, "r", encoding="utf-8") as fh:
+            lines = [line.rstrip("\n") for line in fh if line.strip()]
+
+        replayed = 0
+        undecodable = 0
+        remaining = []
+        for line in lines:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # Truncated or corrupt line: keep it for manual inspection
+                undecodable += 1
+                remaining.append(line)
+                continue
+            try:
+                _replay_record(record)
+                replayed += 1
+            except Exception as e:
+                record["error"] = f"{type(e).__name__}: {str(e)[:200]}"
+                record["kind"] = classify_error(e)
+                remaining.append(json.dumps(record, ensure_ascii=False))
+
+        if remaining:
+            with _append_lock(path), open(path, "a", encoding="utf-8") as fh:
+                for line in remaining:
+                    fh.write(line + "\n")
+        os.remove(replaying_path)
+
+    metrics.incr("dead_letter_replayed", replayed)
+    return {"replayed": replayed, "remaining": len(remaining), "undecodable": undecodable}
+
+
+def _persist_with_retries(collection_name: str, doc: Dict[str, Any]) -> str:
+    attempt = 0
+    while True:
+        if not breaker.allow():
+            metrics.incr("rejected_breaker_open")
+            exc = PersistenceError("circuit breaker open", "transient")
+            write_dead_letter(collection_name, doc, exc, "transient")
+            raise exc
+
+        attempt += 1
+        try:
+            inserted_id = _insert_once(collection_name, doc)
+        except Exception as e:
+            kind = classify_error(e)
+            metrics.incr(f"errors_{kind}")
+            metrics.incr(f"errors.{type(e).__name__}")
+            if kind == "transient":
+                breaker.record_failure()
+            else:
+                # The server answered; a bad payload says nothing about its health
+                breaker.record_success()
+
+            if kind == "transient" and attempt < RETRY_MAX_ATTEMPTS:
+                if retry_budget.withdraw():
+                    metrics.incr("retries")
+                    time.sleep(_backoff_delay(attempt))
+                    continue
+                metrics.incr("retry_budget_exhausted")
+
+            metrics.incr("failures")
+            write_dead_letter(collection_name, doc, e, kind)
+            raise PersistenceError(str(e)[:200], kind) from e
+
+        breaker.record_success()
+        metrics.incr("successes")
+        return inserted_id
+
+
+# =============================================================================
+# PUBLIC API
+# =============================================================================
+
+def persist_document(collection_name: str, data: Union[BaseModel, dict]) -> str:
+    """Insert a document with retries; dead-letters and raises PersistenceError on failure"""
+    if database.db is None:
+        metrics.incr("skipped_no_database")
+        raise PersistenceError("database not configured", "permanent")
+
+    metrics.incr("attempts")
+    retry_budget.deposit()
+    doc = _with_id(data)
+
+    if not _in_flight.acquire(blocking=False):
+        metrics.incr("rejected_in_flight_limit")
+        exc = PersistenceError("too many writes in flight", "transient")
+        write_dead_letter(collection_name, doc, exc, "transient")
+        raise exc
+    try:
+        return _persist_with_retries(collection_name, doc)
+    finally:
+        _in_flight.release()
+
+
+def persistence_stats() -> Dict[str, Any]:
+    """Counters plus breaker state for monitoring"""
+    return {
+        "breaker": breaker.state,
+        "counters": metrics.snapshot(),
+    }
+
+
+if __name__ == "__main__":
+    import sys
+
+    if len(sys.argv) >= 2 and sys.argv[1] == "replay":
+        print(json.dumps(replay_dead_letters(sys.argv[2] if len(sys.argv) > 2 else None)))
+    else:
+        print("usage: python persistence.py replay [dead_letter_path]")
+        sys.exit(2)
@@ -0,0 +1,217 @@
+"""
+Plan Generator
+
+Builds the training plan from a questionnaire. The plan is produced section by
+section (`iter_plan_sections`) in the order clients render it, so the
+streaming endpoint can send each section as soon as it is computed; the
+cheap summary comes first. `build_plan` collects the sections into the
+`resposta` dict returned by POST /generate.
+
+User-facing text comes from the locale's message catalogue through
+`i18n.translator`.
+"""
+
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Tuple
+
+from i18n import DEFAULT_LOCALE, translator
+from prescription import prescribe, prescribe_many
+from schemas import Questionnaire
+
+SECTIONS = ("resumo", "estrategia", "semana1", "recomendacoes", "progresso", "avisos")
+
+
+def iter_plan_sections(
+    q: Questionnaire, locale: str = DEFAULT_LOCALE, prescricao: Optional[Dict[str, Any]] = None,
+) -> Iterator[Tuple[str, Any]]:
+    """Yield (section, content) pairs in SECTIONS order, with text in `locale`.
+
+    `prescricao` is `prescribe(q)`, precomputed when plans are built in bulk.
+    """
+    t = translator(locale)
+
+    # Helper flags
+    objetivo = q.objetivo
+    nivel = q.nivel
+    tem_dor_joelho = any("joelho" in d.lower() for d in (q.lesoes + q.dores))
+    tem_dor_coluna = any(x in d.lower() for d in (q.lesoes + q.dores) for x in ["coluna", "lombar", "costas"])
+    equipamentos = set(e.lower() for e in q.equipamentos)
+
+    # Define frequência e duração
+    freq = q.sessoes_semana
+    dur = min(max(q.tempo_por_sessao_min, 25), 75)
+
+    # Estilo base
+    if q.estilo_preferido:
+        estilo = q.estilo_preferido
+    else:
+        estilo = "full body" if nivel in ["iniciante", "intermediario"] else "upper/lower"
+
+    # Foco do plano
+    if objetivo == "emagrecimento":
+        foco = t("foco.emagrecimento")
+        cardio_final = True
+    elif objetivo == "ganho de massa":
+        foco = t("foco.ganho_de_massa")
+        cardio_final = False
+    elif objetivo == "recomposicao":
+        foco = t("foco.recomposicao")
+        cardio_final = True
+    else:
+        foco = t("foco.geral")
+        cardio_final = True
+
+    # Resumo do aluno
+    resumo = {
+        "objetivo": t(f"objetivo.{objetivo}"),
+        "nivel": t(f"nivel.{nivel}"),
+        "lesoes_limitacoes": q.lesoes + q.dores,
+        "rotina_tempo": t("resumo.rotina_tempo", freq=freq, dur=dur),
+        "estilo": t(f"estilo.{estilo}"),
+        "equipamentos": list(equipamentos) or [t("equipamento.peso_corporal")],
+    }
+
+    yield "resumo", resumo
+
+    # Volume, descanso e RPE calculados a partir dos dados do questionário
+    if prescricao is None:
+        prescricao = prescribe(q)
+    perfis_usados = []
+
+    # Construção do treino da Semana 1
+    def adapt_exec(exercicio, perfil, ajustar=False):
+        dose = prescricao[perfil]
+        perfis_usados.append(perfil)
+        item = {
+            "nome": t(f"ex.{exercicio}.nome"),
+            "series_reps": dose["series_reps"],
+            "descanso_s": dose["descanso_s"],
+            "rpe_alvo": dose["rpe_alvo"],
+            "execucao": t(f"ex.{exercicio}.execucao")
+        }
+        if ajustar:
+            item["ajuste"] = t(f"ex.{exercicio}.ajuste")
+        return item
+
+    aquecimento = [
+        {
+            "exercicio": t("aquecimento.mobilidade.exercicio"),
+            "tempo": t("tempo.minutos", min=2),
+            "descricao": t("aquecimento.mobilidade.descricao"),
+            "adaptacao": t("aquecimento.mobilidade.adaptacao") if tem_dor_coluna else ""
+        },
+        {
+            "exercicio": t("aquecimento.ativacao.exercicio"),
+            "tempo": t("tempo.minutos", min=2),
+            "descricao": t("aquecimento.ativacao.descricao"),
+            "adaptacao": t("aquecimento.ativacao.adaptacao") if tem_dor_joelho else ""
+        }
+    ]
+
+    # Escolha de exercícios conforme equipamentos
+    def tem(eq):
+        return any(eq in e for e in equipamentos)
+
+    principais = []
+
+    # Exercício 1
+    if tem("halter") or tem("dumbbell"):
+        principais.append(adapt_exec("agachamento_goblet", "composto", tem_dor_joelho))
+    elif tem("barra") or tem("smith"):
+        principais.append(adapt_exec("agachamento_smith", "composto", tem_dor_joelho))
+    else:
+        principais.append(adapt_exec("agachamento_peso_corporal", "peso_corporal", True))
+
+    # Exercício 2
+    if tem("maquina") or tem("remada") or tem("cabo"):
+        principais.append(adapt_exec("remada_maquina", "acessorio", tem_dor_coluna))
+    else:
+        principais.append(adapt_exec("remada_curvada", "composto", tem_dor_coluna))
+
+    # Exercício 3
+    if tem("supino") or tem("banco") or tem("halter"):
+        principais.append(adapt_exec("supino_halteres", "composto"))
+    else:
+        principais.append(adapt_exec("flexao_inclinada", "peso_corporal", True))
+
+    # Exercício 4 (opcional) conforme objetivo
+    if objetivo in ["emagrecimento", "recomposicao"]:
+        if tem("kettlebell"):
+            principais.append(adapt_exec("kettlebell_swing", "potencia", tem_dor_coluna))
+        else:
+            principais.append(adapt_exec("terra_romeno", "composto", True))
+
+    finalizacao = None
+    if cardio_final:
+        cardio_tipo = q.cardio_preferido or "caminhada"
+        finalizacao = {
+            "tipo": t(f"cardio.{cardio_tipo}"),
+            "tempo": 8 if objetivo == "ganho de massa" else 12,
+            "intensidade": t("finalizacao.intensidade"),
+            "observacoes": t("finalizacao.observacoes.gasto") if objetivo != "ganho de massa" else t("finalizacao.observacoes.condicionamento")
+        }
+
+    # Estratégia
+    estrategia = {
+        "foco": foco,
+        "estilo": t(f"estilo.{estilo}"),
+        "intensidade_inicial": t("estrategia.intensidade_inicial"),
+        "frequencia": t("estrategia.frequencia", freq=freq),
+        "duracao": t("estrategia.duracao", dur=dur),
+        "volume_semanal_series": sum(prescricao[p]["series_semana"] for p in perfis_usados[:4]),
+        "rpe_alvo": prescricao["composto"]["rpe_alvo"],
+        "cuidados": [
+            t("estrategia.cuidados.joelho") if tem_dor_joelho else "",
+            t("estrategia.cuidados.coluna") if tem_dor_coluna else ""
+        ],
+        "justificativa": t("estrategia.justificativa")
+    }
+    yield "estrategia", estrategia
+
+    plano_semana1 = {
+        "aquecimento": aquecimento,
+        "principais": principais[:4],
+        "finalizacao": finalizacao
+    }
+    yield "semana1", plano_semana1
+
+    recomendacoes = [
+        t("recomendacoes.proteina"),
+        t("recomendacoes.creatina"),
+        t("recomendacoes.sono"),
+        t(
+            "recomendacoes.intervalos",
+            descanso=prescricao["acessorio"]["descanso_s"],
+            descanso_composto=prescricao["composto"]["descanso_s"],
+        ),
+        t("recomendacoes.gatilhos")
+    ]
+    yield "recomendacoes", recomendacoes
+
+    progresso_4s = [
+        t("progresso.semana1", rpe=f"{prescricao['composto']['rpe_alvo']:g}"),
+        t("progresso.semana2"),
+        t("progresso.semana3"),
+        t("progresso.semana4")
+    ]
+    yield "progresso", progresso_4s
+
+    avisos = [
+        t("avisos.dor_aguda"),
+        t("avisos.coluna"),
+        t("avisos.joelho"),
+        t("avisos.consistencia"),
+    ]
+    yield "avisos", avisos
+
+
+def build_plan(q: Questionnaire, locale: str = DEFAULT_LOCALE) -> Dict[str, Any]:
+    """Full plan dict keyed by section"""
+    return dict(iter_plan_sections(q, locale))
+
+
+def build_plans(questionnaires: Sequence[Questionnaire], locale: str = DEFAULT_LOCALE) -> List[Dict[str, Any]]:
+    """Plans for many questionnaires; prescriptions are computed in one vectorised pass"""
+    return [
+        dict(iter_plan_sections(q, locale, prescricao))
+        for q, prescricao in zip(questionnaires, prescribe_many(questionnaires))
+    ]
@@ -0,0 +1,275 @@
+"""
+Prescription Engine
+
+Numeric sets / reps / rest / target-RPE prescription computed from the
+questionnaire biometrics (idade, altura_cm, peso_kg, sexo, comprometimento_nota,
+sono e estresse) instead of fixed strings.
+
+Questionnaires are first encoded into small integer features. The prescription
+itself is a single integer-only kernel that runs either on Python ints (single
+request) or on NumPy int64 arrays (bulk re-planning), so both paths give
+identical results by construction.
+"""
+
+from typing import Any, Dict, List, Optional, Sequence
+
+try:
+    import numpy as np
+except ImportError:  # NumPy is only needed for bulk prescription
+    np = None
+
+NIVEIS = ("iniciante", "intermediario", "avancado")
+OBJETIVOS = ("emagrecimento", "ganho de massa", "recomposicao", "condicionamento", "saude")
+SEXOS = (None, "masculino", "feminino", "outro")
+
+FEATURES = (
+    "nivel", "objetivo", "sexo", "idade", "imc10", "compromisso",
+    "sono", "estresse", "sessoes", "duracao",
+)
+
+# Defaults used when a questionnaire field is missing
+IDADE_PADRAO = 30
+IMC10_PADRAO = 230
+COMPROMISSO_PADRAO = 7
+
+# Tables indexed by nivel / objetivo
+SERIES_BASE = (2, 3, 4)
+RPE10_BASE = (65, 75, 80)
+REPS_MIN = (12, 8, 10, 12, 10)
+REPS_MAX = (15, 12, 12, 15, 15)
+DESCANSO_BASE = (45, 90, 75, 45, 60)
+
+# Exercise profiles: (ajuste de séries, ajuste de reps, ajuste de descanso em s)
+PERFIS = {
+    "composto": (0, 0, 30),
+    "acessorio": (0, 0, 0),
+    "peso_corporal": (1, 3, -15),
+    "potencia": (1, 5, 0),
+}
+
+# Seconds of work per set and seconds reserved for warm-up / finisher
+TEMPO_SERIE_S = 40
+TEMPO_RESERVADO_S = 300
+
+_SONO_RUIM = ("ruim", "pessim", "péssim", "pouco", "insonia", "insônia")
+_SONO_BOM = ("boa", "bom", "otim", "ótim", "excelente")
+_ESTRESSE_ALTO = ("alto", "elevado")
+_ESTRESSE_BAIXO = ("baixo", "pouco", "nenhum")
+
+
+def _nota_texto(texto: Optional[str], negativo: Sequence[str], positivo: Sequence[str]) -> int:
+    """-1 / 0 / +1 from a free-text answer; negative keywords win"""
+    if not texto:
+        return 0
+    t = texto.lower()
+    if any(k in t for k in negativo):
+        return -1
+    if any(k in t for k in positivo):
+        return 1
+    return 0
+
+
+def encode(q) -> tuple:
+    """Encode a Questionnaire into the integer features listed in FEATURES"""
+    if q.peso_kg and q.altura_cm:
+        imc10 = int(round(q.peso_kg * 100000 / (q.altura_cm * q.altura_cm)))
+    else:
+        imc10 = IMC10_PADRAO
+    return (
+        NIVEIS.index(q.nivel),
+        OBJETIVOS.index(q.objetivo),
+        SEXOS.index(q.sexo),
+        q.idade if q.idade is not None else IDADE_PADRAO,
+        imc10,
+        q.comprometimento_nota if q.comprometimento_nota is not None else COMPROMISSO_PADRAO,
+        _nota_texto(q.sono_rotina_qualidade, _SONO_RUIM, _SONO_BOM),
+        # estresse alto = +1, baixo = -1
+        -_nota_texto(q.estresse_nivel, _ESTRESSE_ALTO, _ESTRESSE_BAIXO),
+        q.sessoes_semana,
+        min(max(q.tempo_por_sessao_min, 25), 75),
+    )
+
+
+def encode_columns(questionnaires: Sequence) -> Dict[str, Any]:
+    """Column-wise `encode`: one int64 array per feature (requires NumPy)"""
+    def column(field: str) -> List[Any]:
+        return [getattr(q, field) for q in questionnaires]
+
+    def lookup(values: List[Any], table: Sequence) -> Any:
+        index = {v: i for i, v in enumerate(table)}
+        return np.fromiter((index[v] for v in values), dtype=np.int64, count=len(values))
+
+    def optional(values: List[Any], default: int) -> Any:
+        return np.fromiter((default if v is None else v for v in values), dtype=np.int64, count=len(values))
+
+    def nota(values: List[Any], negativo: Sequence[str], positivo: Sequence[str]) -> Any:
+        # Free-text answers repeat a lot: score each distinct string once
+        notas = {v: _nota_texto(v, negativo, positivo) for v in set(values)}
+        return np.fromiter((notas[v] for v in values), dtype=np.int64, count=len(values))
+
+    peso = np.array([np.nan if v is None else v for v in column("peso_kg")], dtype=np.float64)
+    altura = np.array([np.nan if v is None else v for v in column("altura_cm")], dtype=np.float64)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        # Same float operations as `encode`; rint rounds half to even like round()
+        imc10 = np.rint(peso * 100000 / (altura * altura))
+    conhecido = ~np.isnan(imc10) & (peso != 0) & (altura != 0)
+    imc10 = np.where(conhecido, imc10, IMC10_PADRAO).astype(np.int64)
+
+    return {
+        "nivel": lookup(column("nivel"), NIVEIS),
+        "objetivo": lookup(column("objetivo"), OBJETIVOS),
+        "sexo": lookup(column("sexo"), SEXOS),
+        "idade": optional(column("idade"), IDADE_PADRAO),
+        "imc10": imc10,
+        "compromisso": optional(column("comprometimento_nota"), COMPROMISSO_PADRAO),
+        "sono": nota(column("sono_rotina_qualidade"), _SONO_RUIM, _SONO_BOM),
+        "estresse": -nota(column("estresse_nivel"), _ESTRESSE_ALTO, _ESTRESSE_BAIXO),
+        "sessoes": np.array(column("sessoes_semana"), dtype=np.int64),
+        "duracao": np.clip(np.array(column("tempo_por_sessao_min"), dtype=np.int64), 25, 75),
+    }
+
+
+# =============================================================================
+# KERNEL
+# =============================================================================
+
+class _ScalarOps:
+    @staticmethod
+    def take(table, idx):
+        return table[idx]
+
+    @staticmethod
+    def where(cond, a, b):
+        return a if cond else b
+
+    @staticmethod
+    def clip(x, lo, hi):
+        return min(max(x, lo), hi)
+
+
+class _ArrayOps:
+    @staticmethod
+    def take(table, idx):
+        return np.asarray(table, dtype=np.int64)[idx]
+
+    @staticmethod
+    def where(cond, a, b):
+        return np.where(cond, a, b)
+
+    @staticmethod
+    def clip(x, lo, hi):
+        return np.clip(x, lo, hi)
+
+
+def _kernel(f: Dict[str, Any], ops) -> Dict[str, Any]:
+    """Integer-only prescription; `f` holds ints or int64 arrays keyed by FEATURES"""
+    nivel, objetivo, idade = f["nivel"], f["objetivo"], f["idade"]
+
+    # Recovery score 0–100: sleep, stress, age, body mass and commitment
+    recuperacao = (
+        60
+        + 15 * f["sono"]
+        - 15 * f["estresse"]
+        - ops.clip((idade - 45) // 2, 0, 20)
+        + 5 * (idade < 25)
+        - 10 * (f["imc10"] >= 300)
+        - 5 * (f["imc10"] >= 350)
+        + 2 * (f["compromisso"] - 5)
+    )
+    recuperacao = ops.clip(recuperacao, 0, 100)
+    boa = recuperacao >= 75
+    baixa = recuperacao < 40
+
+    series = ops.take(SERIES_BASE, nivel) + 1 * boa - 1 * baixa
+    rpe10 = ops.clip(ops.take(RPE10_BASE, nivel) + 5 * boa - 10 * baixa, 60, 90)
+    reps_min = ops.take(REPS_MIN, objetivo) + 2 * (nivel == 0)
+    reps_max = ops.take(REPS_MAX, objetivo) + 2 * (nivel == 0)
+    descanso = (
+        ops.take(DESCANSO_BASE, objetivo)
+        + 15 * (idade >= 50)
+        + 15 * baixa
+        - 15 * (f["sexo"] == 2)
+    )
+
+    # Cap sets so every exercise fits in the session, sized on the compound rest
+    n_exercicios = ops.where((objetivo == 0) | (objetivo == 2), 4, 3)
+    descanso_composto = ops.clip(descanso + PERFIS["composto"][2], 30, 180)
+    orcamento = f["duracao"] * 60 - TEMPO_RESERVADO_S
+    max_series = ops.clip(orcamento // ((TEMPO_SERIE_S + descanso_composto) * n_exercicios), 1, 6)
+
+    out: Dict[str, Any] = {"recuperacao": recuperacao}
+    for perfil, (d_series, d_reps, d_descanso) in PERFIS.items():
+        s = ops.clip(ops.clip(series + d_series, 1, 6), 1, max_series)
+        r_max = reps_max + d_reps
+        out[perfil] = {
+            "series": s,
+            "reps_min": reps_min + d_reps,
+            "reps_max": r_max,
+            "descanso_s": ops.clip(descanso + d_descanso, 30, 180) // 15 * 15,
+            "rpe10": rpe10,
+            # Rough %1RM from reps in reserve: ~2.5% per rep to failure
+            "pct_1rm": ops.clip(100 - 5 * (r_max + (100 - rpe10) // 10) // 2, 40, 90),
+            "series_semana": s * f["sessoes"],
+        }
+    return out
+
+
+def _format(valores: Dict[str, int]) -> Dict[str, Any]:
+    return {
+        "series": valores["series"],
+        "reps_min": valores["reps_min"],
+        "reps_max": valores["reps_max"],
+        "series_reps": f"{valores['series']} x {valores['reps_min']}–{valores['reps_max']}",
+        "descanso_s": valores["descanso_s"],
+        "rpe_alvo": valores["rpe10"] / 10,
+        "pct_1rm_estimado": valores["pct_1rm"],
+        "series_semana": valores["series_semana"],
+    }
+
+
+# =============================================================================
+# PUBLIC API
+# =============================================================================
+
+def prescribe(q) -> Dict[str, Any]:
+    """Pure-Python prescription for a single questionnaire, keyed by exercise profile"""
+    bruto = _kernel(dict(zip(FEATURES, encode(q))), _ScalarOps)
+    resultado: Dict[str, Any] = {"recuperacao": bruto["recuperacao"]}
+    for perfil in PERFIS:
+        resultado[perfil] = _format(bruto[perfil])
+    return resultado
+
+
+def prescribe_arrays(questionnaires: Sequence) -> Dict[str, Any]:
+    """Vectorised prescription; returns int64 arrays keyed like `_kernel`"""
+    if np is None:
+        raise RuntimeError("NumPy is required for bulk prescription (pip install numpy)")
+    return _kernel(encode_columns(questionnaires), _ArrayOps)
+
+
+def prescribe_many(questionnaires: Sequence) -> List[Dict[str, Any]]:
+    """Bulk prescription with the same output as calling `prescribe` per item"""
+    if np is None:
+        return [prescribe(q) for q in questionnaires]
+
+    bruto = prescribe_arrays(questionnaires)
+    resultados: List[Dict[str, Any]] = [{"recuperacao": r} for r in bruto["recuperacao"].tolist()]
+    for perfil in PERFIS:
+        # Same fields as `_format`, built per column instead of per row
+        v = {nome: arr.tolist() for nome, arr in bruto[perfil].items()}
+        v["rpe_alvo"] = (bruto[perfil]["rpe10"] / 10).tolist()
+        for resultado, series, reps_min, reps_max, descanso, rpe, pct, semana in zip(
+            resultados, v["series"], v["reps_min"], v["reps_max"], v["descanso_s"],
+            v["rpe_alvo"], v["pct_1rm"], v["series_semana"],
+        ):
+            resultado[perfil] = {
+                "series": series,
+                "reps_min": reps_min,
+                "reps_max": reps_max,
+                "series_reps": f"{series} x {reps_min}–{reps_max}",
+                "descanso_s": descanso,
+                "rpe_alvo": rpe,
+                "pct_1rm_estimado": pct,
+                "series_semana": semana,
+            }
+    return resultados
@@ -0,0 +1,237 @@
+"""
+Progress Tracking
+
+Workout logs are stored in pre-aggregated weekly buckets: one document per
+assessment per ISO week in the "progress_week" collection. Ingestion groups a
+batch of logs by bucket and issues a single upsert per bucket ($inc for the
+totals, $push for the raw sets), so write cost scales with buckets touched,
+not with sets logged. Logs sent with a client `log_id` are recorded in the
+bucket and never counted twice, so clients can safely retry a failed batch. Reads return the weekly totals straight from the buckets
+and never scan raw logs.
+"""
+
+import threading
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, List, Sequence, Tuple
+
+from bson import ObjectId
+from bson.errors import InvalidId
+from pymongo import DESCENDING, UpdateOne
+from pymongo.errors import BulkWriteError
+
+import database
+import events
+from schemas import WorkoutLog
+
+COLLECTION = "progress_week"
+
+# Raw sets kept per bucket ($slice keeps the most recent ones)
+MAX_RAW_SETS = 2000
+
+# Planned sessions per assessment, cached to avoid a lookup per ingest
+_PLANNED_CACHE_SIZE = 10000
+_planned_sessions: "OrderedDict[str, int]" = OrderedDict()
+_planned_lock = threading.Lock()
+
+_indexes_ready = False
+
+
+class ProgressError(Exception):
+    """Raised for logs that reference an unknown or invalid assessment"""
+
+
+class InvalidAssessmentId(ProgressError):
+    """assessment_id is not a valid ObjectId"""
+
+
+class AssessmentNotFound(ProgressError):
+    """No assessment with this id"""
+
+
+def _as_utc(moment: datetime) -> datetime:
+    if moment.tzinfo is None:
+        return moment.replace(tzinfo=timezone.utc)
+    return moment.astimezone(timezone.utc)
+
+
+def week_start(moment: datetime) -> str:
+    """Monday (UTC) of the ISO week containing `moment`, as YYYY-MM-DD"""
+    day = _as_utc(moment).date()
+    return (day - timedelta(days=day.weekday())).isoformat()
+
+
+def _ensure_indexes():
+    global _indexes_ready
+    if _indexes_ready:
+        return
+    database.db[COLLECTION].create_index([("assessment_id", 1), ("semana", 1)], unique=True)
+    _indexes_ready = True
+
+
+def _planned_for(assessment_id: str) -> int:
+    """Sessões por semana do questionário da avaliação (cacheado)"""
+    with _planned_lock:
+        cached = _planned_sessions.get(assessment_id)
+        if cached is not None:
+            _planned_sessions.move_to_end(assessment_id)
+            return cached
+
+    try:
+        oid = ObjectId(assessment_id)
+    except (InvalidId, TypeError):
+        raise InvalidAssessmentId(f"invalid assessment_id: {assessment_id}")
+
+    doc = database.db["assessment"].find_one({"_id": oid}, {"questionnaire.sessoes_semana": 1})
+    if doc is None:
+        raise AssessmentNotFound(f"assessment not found: {assessment_id}")
+
+    planned = int(doc.get("questionnaire", {}).get("sessoes_semana") or 0)
+    with _planned_lock:
+        _planned_sessions[assessment_id] = planned
+        if len(_planned_sessions) > _PLANNED_CACHE_SIZE:
+            _planned_sessions.popitem(last=False)
+    return planned
+
+
+def _invalidate_planned(event: Dict[str, Any]):
+    with _planned_lock:
+        if event["operation"] == "flush":
+            _planned_sessions.clear()
+        else:
+            _planned_sessions.pop(event["document_id"], None)
+
+
+events.register_cache("progress.planned_sessions", _invalidate_planned)
+
+
+def _log_update(entries: List[Dict[str, Any]], now: datetime) -> Dict[str, Any]:
+    """$inc/$push update folding `entries` (one per log) into a bucket"""
+    inc: Dict[str, Any] = {}
+    for entry in entries:
+        inc["total_series"] = inc.get("total_series", 0) + 1
+        inc["total_reps"] = inc.get("total_reps", 0) + entry["reps"]
+        inc["volume_kg"] = inc.get("volume_kg", 0) + entry["reps"] * entry["carga_kg"]
+        day = f"dias.{entry['realizado_em'].date().isoformat()}"
+        inc[day] = inc.get(day, 0) + 1
+
+    push: Dict[str, Any] = {"series": {"$each": entries, "$slice": -MAX_RAW_SETS}}
+    log_ids = [e["log_id"] for e in entries if e["log_id"] is not None]
+    if log_ids:
+        push["log_ids"] = {"$each": log_ids, "$slice": -MAX_RAW_SETS}
+    return {"$inc": inc, "$push": push, "$set": {"updated_at": now}}
+
+
+def ingest_logs(logs: Sequence[WorkoutLog]) -> Dict[str, int]:
+    """Fold a batch of logs into their weekly buckets with one upsert per bucket.
+
+    Logs that carry a `log_id` are counted once: a bucket update only matches
+    if none of its log_ids is recorded yet, and a bucket that already has some
+    of them (a client retry after a partial failure) falls back to one
+    conditional update per log. Logs without `log_id` are not idempotent.
+    """
+    if database.db is None:
+        raise Exception("Database not available. Check DATABASE_URL and DATABASE_NAME environment variables.")
+    _ensure_indexes()
+
+    now = datetime.now(timezone.utc)
+    grouped: Dict[Tuple[str, str], List[Dict[str, Any]]] = {}
+    seen: set = set()
+    duplicates = 0
+
+    for log in logs:
+        if log.log_id is not None:
+            if (log.assessment_id, log.log_id) in seen:
+                duplicates += 1
+                continue
+            seen.add((log.assessment_id, log.log_id))
+        moment = _as_utc(log.realizado_em) if log.realizado_em else now
+        grouped.setdefault((log.assessment_id, week_start(moment)), []).append({
+            "log_id": log.log_id,
+            "exercicio": log.exercicio,
+            "serie": log.serie,
+            "reps": log.reps,
+            "carga_kg": log.carga_kg,
+            "rpe": log.rpe,
+            "realizado_em": moment,
+        })
+
+    buckets = list(grouped.items())
+    operations = []
+    for (assessment_id, semana), entries in buckets:
+        update = _log_update(entries, now)
+        update["$setOnInsert"] = {
+            "sessoes_planejadas": _planned_for(assessment_id),
+            "created_at": now,
+        }
+        query: Dict[str, Any] = {"assessment_id": assessment_id, "semana": semana}
+        log_ids = [e["log_id"] for e in entries if e["log_id"] is not None]
+        if log_ids:
+            query["log_ids"] = {"$nin": log_ids}
+        operations.append(UpdateOne(query, update, upsert=True))
+
+    collection = database.db[COLLECTION]
+    retry_per_log: List[int] = []
+    if operations:
+        try:
+            collection.bulk_write(operations, ordered=False)
+        except BulkWriteError as e:
+            errors = e.details.get("writeErrors", [])
+            if any(err.get("code") != 11000 for err in errors):
+                raise
+            # Upsert hit the unique (assessment_id, semana) index: the bucket
+            # exists and already holds some of these log_ids
+            retry_per_log = [err["index"] for err in errors]
+
+    for index in retry_per_log:
+        (assessment_id, semana), entries = buckets[index]
+        for entry in entries:
+            query = {"assessment_id": assessment_id, "semana": semana}
+            if entry["log_id"] is not None:
+                query["log_ids"] = {"$ne": entry["log_id"]}
+            if collection.update_one(query, _log_update([entry], now)).matched_count == 0:
+                duplicates += 1
+
+    return {"logs": len(logs) - duplicates, "duplicates": duplicates, "buckets": len(operations)}
+
+
+def _week_summary(doc: Dict[str, Any]) -> Dict[str, Any]:
+    dias_treinados = len(doc.get("dias") or {})
+    planejadas = doc.get("sessoes_planejadas") or 0
+    return {
+        "semana": doc["semana"],
+        "series": doc.get("total_series", 0),
+        "reps": doc.get("total_reps", 0),
+        "volume_kg": round(doc.get("volume_kg", 0), 1),
+        "dias_treinados": dias_treinados,
+        "sessoes_planejadas": planejadas,
+        "aderencia": round(min(dias_treinados / planejadas, 1.0), 2) if planejadas else None,
+    }
+
+
+def weekly_progress(assessment_id: str, semanas: int = 12) -> List[Dict[str, Any]]:
+    """Most recent `semanas` weekly summaries, oldest first, read from buckets only"""
+    if database.db is None:
+        raise Exception("Database not available. Check DATABASE_URL and DATABASE_NAME environment variables.")
+    # Same checks as ingestion: malformed or unknown ids are errors, not empty weeks
+    _planned_for(assessment_id)
+
+    cursor = (
+        database.db[COLLECTION]
+        .find({"assessment_id": assessment_id}, {"series": 0})
+        .sort("semana", DESCENDING)
+        .limit(semanas)
+    )
+    return [_week_summary(doc) for doc in reversed(list(cursor))]
+
+
+def progress_overview(assessment_id: str, semanas: int = 12) -> Dict[str, Any]:
+    """Weekly summaries plus totals across the returned weeks"""
+    semanas_resumo = weekly_progress(assessment_id, semanas)
+    aderencias = [s["aderencia"] for s in semanas_resumo if s["aderencia"] is not None]
+    return {
+        "assessment_id": assessment_id,
+        "semanas": semanas_resumo,
+        "volume_total_kg": round(sum(s["volume_kg"] for s in semanas_resumo), 1),
+        "aderencia_media": round(sum(aderencias) / len(aderencias), 2) if aderencias else None,
+    }
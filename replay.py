@@ -0,0 +1,394 @@
+"""
+Shadow Replay
+
+Differential testing harness for the plan generator. Replays stored
+questionnaires (the "assessment" collection, or a captured NDJSON file)
+through two generator versions side by side on a process pool, and reports
+plan differences grouped by category together with per-version throughput and
+latency. Latency percentiles are wall time per call; throughput is computed
+from the calling thread's CPU time, so it stays a per-core figure even when
+there are more workers than cores. The two versions run in alternating order
+from record to record so warm caches favour neither.
+
+A version is a git revision (exported to a temporary directory) or WORKTREE
+for the files on disk. Each worker imports both versions in isolation, so the
+two `planner` modules never share state. The entry point is `module:function`
+and must be a pure function of the questionnaire (default: planner:build_plan).
+
+Usage:
+    python replay.py --old HEAD~1 --new WORKTREE
+    python replay.py --old v1.4 --new HEAD --source captured.ndjson --workers 16
+"""
+
+import argparse
+import importlib
+import itertools
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+WORKTREE = "WORKTREE"
+EXAMPLES_PER_CATEGORY = 5
+LATENCY_BUCKETS = 40  # power-of-two microsecond buckets
+
+
+# =============================================================================
+# VERSIONS
+# =============================================================================
+
+def export_revision(revision: str, dest: str) -> str:
+    """Materialise a git revision's tree into `dest` and return the path"""
+    if revision == WORKTREE:
+        return REPO_DIR
+    archive = subprocess.run(
+        ["git", "-C", REPO_DIR, "archive", "--format=tar", revision],
+        check=True, capture_output=True,
+    )
+    root = os.path.join(dest, revision.replace("/", "_").replace("~", "_").replace("^", "_"))
+    os.makedirs(root, exist_ok=True)
+    subprocess.run(["tar", "-x", "-C", root], input=archive.stdout, check=True)
+    return root
+
+
+def _under(module: Any, root: str) -> bool:
+    path = getattr(module, "__file__", None)
+    return bool(path) and os.path.abspath(path).startswith(root + os.sep)
+
+
+def _isolated_path(root: str) -> List[str]:
+    """sys.path with `root` first and every entry that could shadow it removed"""
+    shadowing = {REPO_DIR, os.getcwd(), root}
+    return [root] + [
+        p for p in sys.path
+        if os.path.abspath(p or os.curdir) not in shadowing
+    ]
+
+
+def load_version(root: str, entry: str) -> Tuple[Callable, Any]:
+    """Import `entry` and schemas.Questionnaire from `root` without leaking modules.
+
+    The repository checkout and the working directory are taken off sys.path
+    for the import, and the imported modules must come from `root`; a revision
+    that lacks the entry module (e.g. one that predates planner.py) is rejected
+    with ImportError instead of silently running the files on disk.
+    """
+    root = os.path.abspath(root)
+    keep = {"__main__", "__mp_main__", __name__}
+
+    def purge():
+        for name, module in list(sys.modules.items()):
+            if name not in keep and (_under(module, root) or _under(module, REPO_DIR)):
+                del sys.modules[name]
+
+    module_name, func_name = entry.split(":")
+    purge()
+    saved_path = sys.path[:]
+    sys.path[:] = _isolated_path(root)
+    try:
+        try:
+            module = importlib.import_module(module_name)
+            schemas = importlib.import_module("schemas")
+        except ModuleNotFoundError as e:
+            raise ImportError(f"{root}: revision cannot provide entry {entry}: {e}") from e
+        for imported in (module, schemas):
+            if not _under(imported, root):
+                raise ImportError(
+                    f"{root}: '{imported.__name__}' was imported from "
+                    f"{getattr(imported, '__file__', None)}, outside the revision"
+                )
+        func = getattr(module, func_name)
+        questionnaire_cls = schemas.Questionnaire
+    finally:
+        sys.path[:] = saved_path
+        purge()
+    return func, questionnaire_cls
+
+
+# =============================================================================
+# WORKER
+# =============================================================================
+
+_versions: Dict[str, Tuple[Callable, Any]] = {}
+_locale: Optional[str] = None
+
+
+def _init_worker(roots: Dict[str, str], entry: str, locale: Optional[str]):
+    global _locale
+    _locale = locale
+    for label, root in roots.items():
+        _versions[label] = load_version(root, entry)
+
+
+def _run_one(label: str, raw: Dict[str, Any]) -> Tuple[Optional[Any], Optional[str], float, float]:
+    """(plan, error, wall seconds, thread CPU seconds) for one call"""
+    func, questionnaire_cls = _versions[label]
+    try:
+        q = questionnaire_cls.model_validate(raw)
+    except Exception as e:
+        return None, f"invalid_input:{type(e).__name__}", 0.0, 0.0
+    plan, error = None, None
+    start, start_cpu = time.perf_counter(), time.thread_time()
+    try:
+        plan = func(q, _locale) if _locale else func(q)
+    except Exception as e:
+        error = f"exception:{type(e).__name__}"
+    return plan, error, time.perf_counter() - start, time.thread_time() - start_cpu
+
+
+def _diff(a: Any, b: Any, path: str, out: set):
+    if isinstance(a, dict) and isinstance(b, dict):
+        for key in a.keys() | b.keys():
+            child = f"{path}.{key}" if path else str(key)
+            if key not in b:
+                out.add(f"{child}:removed")
+            elif key not in a:
+                out.add(f"{child}:added")
+            else:
+                _diff(a[key], b[key], child, out)
+    elif isinstance(a, list) and isinstance(b, list):
+        child = f"{path}[]"
+        for x, y in zip(a, b):
+            _diff(x, y, child, out)
+        if len(a) > len(b):
+            out.add(f"{child}:removed")
+        elif len(b) > len(a):
+            out.add(f"{child}:added")
+    elif type(a) is not type(b):
+        out.add(f"{path or '<root>'}:type_changed")
+    elif a != b:
+        out.add(f"{path or '<root>'}:changed")
+
+
+def _empty_latency() -> Dict[str, Any]:
+    return {"count": 0, "errors": 0, "total_s": 0.0, "cpu_s": 0.0, "max_s": 0.0, "buckets": [0] * LATENCY_BUCKETS}
+
+
+def _record(stats: Dict[str, Any], seconds: float, cpu_seconds: float, error: Optional[str]):
+    stats["count"] += 1
+    if error:
+        stats["errors"] += 1
+    stats["total_s"] += seconds
+    stats["cpu_s"] += cpu_seconds
+    stats["max_s"] = max(stats["max_s"], seconds)
+    bucket = min(int(seconds * 1e6).bit_length(), LATENCY_BUCKETS - 1)
+    stats["buckets"][bucket] += 1
+
+
+def _replay_chunk(chunk: List[Tuple[str, Dict[str, Any]]]) -> Dict[str, Any]:
+    categories: Counter = Counter()
+    examples: Dict[str, List[str]] = {}
+    latency = {label: _empty_latency() for label in _versions}
+    identical = 0
+    labels = list(_versions)
+
+    for index, (record_id, raw) in enumerate(chunk):
+        results = {}
+        for label in (labels if index % 2 == 0 else labels[::-1]):
+            plan, error, seconds, cpu_seconds = _run_one(label, raw)
+            _record(latency[label], seconds, cpu_seconds, error)
+            results[label] = (plan, error)
+
+        (old_plan, old_error), (new_plan, new_error) = results["old"], results["new"]
+        found = set()
+        if old_error or new_error:
+            if old_error:
+                found.add(f"<error>:old:{old_error}")
+            if new_error:
+                found.add(f"<error>:new:{new_error}")
+        else:
+            _diff(old_plan, new_plan, "", found)
+
+        if not found:
+            identical += 1
+        for category in found:
+            categories[category] += 1
+            bucket = examples.setdefault(category, [])
+            if len(bucket) < EXAMPLES_PER_CATEGORY:
+                bucket.append(record_id)
+
+    return {
+        "replayed": len(chunk),
+        "identical": identical,
+        "categories": categories,
+        "examples": examples,
+        "latency": latency,
+    }
+
+
+# =============================================================================
+# SOURCES
+# =============================================================================
+
+def iter_ndjson(path: str) -> Iterator[Tuple[str, Dict[str, Any]]]:
+    """Lines are a questionnaire or a document with a `questionnaire` field"""
+    with open(path, encoding="utf-8") as fh:
+        for line_no, line in enumerate(fh, 1):
+            if not line.strip():
+                continue
+            doc = json.loads(line)
+            record_id = str(doc.get("_id") or doc.get("assessment_id") or f"line:{line_no}")
+            yield record_id, doc.get("questionnaire", doc)
+
+
+def iter_assessments(batch_size: int = 2000) -> Iterator[Tuple[str, Dict[str, Any]]]:
+    """Stream questionnaires from the assessment collection"""
+    import database
+
+    if database.db is None:
+        raise SystemExit("Database not available. Check DATABASE_URL and DATABASE_NAME environment variables.")
+    cursor = database.db["assessment"].find({}, {"questionnaire": 1}).batch_size(batch_size)
+    for doc in cursor:
+        if doc.get("questionnaire"):
+            yield str(doc["_id"]), doc["questionnaire"]
+
+
+def _chunks(records: Iterator, size: int) -> Iterator[List]:
+    while True:
+        chunk = list(itertools.islice(records, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+# =============================================================================
+# REPORT
+# =============================================================================
+
+def _merge(total: Dict[str, Any], part: Dict[str, Any]):
+    total["replayed"] += part["replayed"]
+    total["identical"] += part["identical"]
+    total["categories"].update(part["categories"])
+    for category, ids in part["examples"].items():
+        bucket = total["examples"].setdefault(category, [])
+        bucket.extend(ids[:EXAMPLES_PER_CATEGORY - len(bucket)])
+    for label, stats in part["latency"].items():
+        agg = total["latency"].setdefault(label, _empty_latency())
+        agg["count"] += stats["count"]
+        agg["errors"] += stats["errors"]
+        agg["total_s"] += stats["total_s"]
+        agg["cpu_s"] += stats["cpu_s"]
+        agg["max_s"] = max(agg["max_s"], stats["max_s"])
+        agg["buckets"] = [x + y for x, y in zip(agg["buckets"], stats["buckets"])]
+
+
+def _percentile_us(buckets: List[int], count: int, pct: float) -> Optional[int]:
+    """Upper bound of the power-of-two bucket holding the percentile"""
+    if not count:
+        return None
+    target = pct * count
+    seen = 0
+    for idx, n in enumerate(buckets):
+        seen += n
+        if seen >= target:
+            return 1 << idx
+    return 1 << (len(buckets) - 1)
+
+
+def build_report(total: Dict[str, Any], wall_s: float, args: argparse.Namespace) -> Dict[str, Any]:
+    versions = {}
+    for label, stats in total["latency"].items():
+        count = stats["count"]
+        versions[label] = {
+            "revision": getattr(args, label),
+            "calls": count,
+            "errors": stats["errors"],
+            "mean_us": round(stats["total_s"] / count * 1e6, 1) if count else None,
+            "cpu_mean_us": round(stats["cpu_s"] / count * 1e6, 1) if count else None,
+            "p50_us_le": _percentile_us(stats["buckets"], count, 0.50),
+            "p95_us_le": _percentile_us(stats["buckets"], count, 0.95),
+            "p99_us_le": _percentile_us(stats["buckets"], count, 0.99),
+            "max_us": round(stats["max_s"] * 1e6, 1),
+            # Single-core throughput: calls per second of generator CPU time
+            "plans_per_core_s": round(count / stats["cpu_s"], 1) if stats["cpu_s"] else None,
+        }
+
+    sections: Counter = Counter()
+    for category, n in total["categories"].items():
+        path = category.split(":", 1)[0]
+        sections[path.split(".", 1)[0].split("[", 1)[0]] += n
+
+    replayed = total["replayed"]
+    return {
+        "replayed": replayed,
+        "identical": total["identical"],
+        "changed": replayed - total["identical"],
+        "wall_s": round(wall_s, 2),
+        "replays_per_s": round(replayed / wall_s, 1) if wall_s else None,
+        "versions": versions,
+        "by_section": dict(sections.most_common()),
+        "by_category": dict(total["categories"].most_common()),
+        "examples": total["examples"],
+    }
+
+
+def _print_summary(report: Dict[str, Any]):
+    print(f"replayed {report['replayed']} in {report['wall_s']}s "
+          f"({report['replays_per_s']}/s): {report['identical']} identical, {report['changed']} changed")
+    for label, v in report["versions"].items():
+        print(f"  {label:>3} {v['revision']}: mean {v['mean_us']}us (cpu {v['cpu_mean_us']}us)  p50<={v['p50_us_le']}us  "
+              f"p95<={v['p95_us_le']}us  p99<={v['p99_us_le']}us  {v['plans_per_core_s']} plans/core-s  "
+              f"errors {v['errors']}")
+    for category, n in list(report["by_category"].items())[:20]:
+        print(f"  {n:>9}  {category}")
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="Replay questionnaires through two generator versions")
+    parser.add_argument("--old", required=True, help="git revision of the baseline generator")
+    parser.add_argument("--new", default=WORKTREE, help=f"git revision of the candidate ({WORKTREE} = files on disk)")
+    parser.add_argument("--entry", default="planner:build_plan", help="module:function taking a Questionnaire")
+    parser.add_argument("--source", help="NDJSON capture; defaults to the assessment collection")
+    parser.add_argument("--limit", type=int, help="replay at most N questionnaires")
+    parser.add_argument("--locale", help="pass this locale as the entry's second argument")
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--chunk-size", type=int, default=500)
+    parser.add_argument("--out", help="write the JSON report here")
+    args = parser.parse_args(argv)
+
+    records = iter_ndjson(args.source) if args.source else iter_assessments()
+    if args.limit:
+        records = itertools.islice(records, args.limit)
+
+    total = {"replayed": 0, "identical": 0, "categories": Counter(), "examples": {}, "latency": {}}
+    with tempfile.TemporaryDirectory(prefix="replay-") as tmp:
+        roots = {"old": export_revision(args.old, tmp), "new": export_revision(args.new, tmp)}
+        # Fail here, not in every pool worker, when a revision cannot be loaded
+        for label, root in roots.items():
+            try:
+                load_version(root, args.entry)
+            except (ImportError, AttributeError) as e:
+                raise SystemExit(f"--{label} {getattr(args, label)}: {e}")
+        start = time.perf_counter()
+        with ProcessPoolExecutor(
+            max_workers=args.workers,
+            initializer=_init_worker,
+            initargs=(roots, args.entry, args.locale),
+        ) as pool:
+            # Bounded in-flight chunks keep memory flat for large replays
+            pending = set()
+            for chunk in _chunks(iter(records), args.chunk_size):
+                pending.add(pool.submit(_replay_chunk, chunk))
+                if len(pending) >= args.workers * 2:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        _merge(total, future.result())
+            for future in pending:
+                _merge(total, future.result())
+        wall_s = time.perf_counter() - start
+
+    report = build_report(total, wall_s, args)
+    _print_summary(report)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as fh:
+            json.dump(report, fh, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -13,6 +13,7 @@ Model name is converted to lowercase for the collection name:
 
 from pydantic import BaseModel, Field
 from typing import Optional, List, Literal, Dict, Any
+from datetime import datetime
 
 # Example schemas (retain for reference)
 class User(BaseModel):
@@ -168,6 +169,38 @@ class Assessment(BaseModel):
     """Documento salvo com questionário e plano gerado"""
     questionnaire: Questionnaire
     plan: Dict[str, Any]
+    locale: str = Field("pt", description="Idioma em que o plano foi renderizado")
+
+
+class WorkoutLog(BaseModel):
+    """Uma série registrada pelo aluno, vinculada a uma avaliação (plano gerado)"""
+    assessment_id: str = Field(..., description="ID do documento em assessment")
+    log_id: Optional[str] = Field(
+        None, min_length=1, max_length=64,
+        description="Chave de idempotência gerada pelo cliente; reenvios com o mesmo log_id não contam de novo",
+    )
+    exercicio: str = Field(..., min_length=1, max_length=120)
+    serie: Optional[int] = Field(None, ge=1, le=20)
+    reps: int = Field(..., ge=0, le=100)
+    carga_kg: float = Field(0, ge=0, le=1000)
+    rpe: Optional[float] = Field(None, ge=1, le=10)
+    realizado_em: Optional[datetime] = Field(None, description="Momento da série (UTC); padrão: agora")
+
+
+class ProgressWeek(BaseModel):
+    """
+    Bucket semanal de progresso (um documento por avaliação por semana)
+    Collection name: "progress_week"
+    """
+    assessment_id: str
+    semana: str = Field(..., description="Segunda-feira da semana ISO, YYYY-MM-DD")
+    sessoes_planejadas: int = Field(..., ge=0, le=7)
+    total_series: int = 0
+    total_reps: int = 0
+    volume_kg: float = 0
+    dias: Dict[str, int] = Field(default_factory=dict, description="Séries por dia (YYYY-MM-DD)")
+    series: List[Dict[str, Any]] = Field(default_factory=list, description="Séries brutas mais recentes")
+    log_ids: List[str] = Field(default_factory=list, description="log_id das séries já contadas (mais recentes)")
 
 # Note: The Flames database viewer will automatically:
 # 1. Read these schemas from GET /schema endpoint
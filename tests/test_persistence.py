@@ -0,0 +1,138 @@
+import json
+
+import pytest
+from pymongo import errors as mongo_errors
+
+import persistence
+from persistence import CircuitBreaker, PersistenceError, classify_error
+
+
+@pytest.fixture
+def store(monkeypatch, tmp_path):
+    """Fake collection behind `create_document`; tests script its failures"""
+    docs = {}
+    failures = []
+
+    def create_document(collection_name, doc):
+        if failures:
+            raise failures.pop(0)
+        if doc["_id"] in docs:
+            raise mongo_errors.DuplicateKeyError(
+                "E11000 duplicate key error index: _id_", 11000, {"keyPattern": {"_id": 1}},
+            )
+        docs[doc["_id"]] = dict(doc)
+        return str(doc["_id"])
+
+    monkeypatch.setattr(persistence, "create_document", create_document)
+    monkeypatch.setattr(persistence.database, "db", object())
+    monkeypatch.setattr(persistence, "breaker", CircuitBreaker(3, 60.0))
+    monkeypatch.setattr(persistence, "retry_budget", persistence.RetryBudget(1.0, 100))
+    monkeypatch.setattr(persistence, "RETRY_BASE_DELAY_S", 0.0)
+    monkeypatch.setattr(persistence, "DEAD_LETTER_PATH", str(tmp_path / "dead_letter.ndjson"))
+    return docs, failures
+
+
+@pytest.mark.parametrize("exc, kind", [
+    (mongo_errors.NetworkTimeout("timed out"), "transient"),
+    (mongo_errors.ServerSelectionTimeoutError("no primary"), "transient"),
+    (mongo_errors.NotPrimaryError("stepped down"), "transient"),
+    (mongo_errors.OperationFailure("throttled", code=16500), "transient"),
+    (mongo_errors.OperationFailure("bad value", code=2), "permanent"),
+    (mongo_errors.DuplicateKeyError("E11000 email_1", 11000), "permanent"),
+    (TimeoutError(), "transient"),
+    (ValueError("bad payload"), "permanent"),
+])
+def test_classify_error(exc, kind):
+    assert classify_error(exc) == kind
+
+
+def test_breaker_opens_and_half_opens(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(persistence.time, "monotonic", lambda: now[0])
+    breaker = CircuitBreaker(failure_threshold=2, reset_timeout_s=10.0)
+
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.CLOSED and breaker.allow()
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.OPEN and not breaker.allow()
+
+    now[0] += 10.0
+    assert breaker.allow()          # the single half-open probe
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    assert not breaker.allow()
+
+    breaker.record_failure()        # failed probe reopens immediately
+    assert breaker.state == CircuitBreaker.OPEN
+
+    now[0] += 10.0
+    assert breaker.allow()
+    breaker.record_success()
+    assert breaker.state == CircuitBreaker.CLOSED and breaker.allow()
+
+
+def test_retry_after_ambiguous_timeout_stores_one_document(store, monkeypatch):
+    docs, _ = store
+    insert = persistence.create_document
+    seen_ids = []
+
+    def create_document(collection_name, doc):
+        seen_ids.append(doc["_id"])
+        result = insert(collection_name, doc)
+        if len(seen_ids) == 1:
+            raise mongo_errors.NetworkTimeout("timed out after the write committed")
+        return result
+
+    monkeypatch.setattr(persistence, "create_document", create_document)
+    inserted_id = persistence.persist_document("assessment", {"x": 1})
+
+    assert len(seen_ids) == 2 and seen_ids[0] == seen_ids[1]
+    assert len(docs) == 1
+    assert inserted_id == str(seen_ids[0])
+    assert persistence.metrics.snapshot().get("duplicate_id_ignored", 0) >= 1
+
+
+def test_permanent_errors_do_not_open_breaker(store):
+    _, failures = store
+    for _ in range(5):
+        failures.append(mongo_errors.OperationFailure("bad value", code=2))
+        with pytest.raises(PersistenceError) as info:
+            persistence.persist_document("assessment", {"x": 1})
+        assert info.value.kind == "permanent"
+    assert persistence.breaker.state == CircuitBreaker.CLOSED
+
+
+def test_in_flight_limit_fails_fast(store, monkeypatch):
+    docs, _ = store
+    full = persistence.threading.BoundedSemaphore(1)
+    full.acquire()
+    monkeypatch.setattr(persistence, "_in_flight", full)
+
+    with pytest.raises(PersistenceError) as info:
+        persistence.persist_document("assessment", {"x": 1})
+    assert info.value.kind == "transient"
+    assert not docs
+    with open(persistence.DEAD_LETTER_PATH, encoding="utf-8") as fh:
+        assert len(fh.readlines()) == 1
+
+
+def test_dead_letter_replay_keeps_id_and_corrupt_lines(store):
+    docs, failures = store
+    failures.extend([mongo_errors.NetworkTimeout("down")] * persistence.RETRY_MAX_ATTEMPTS)
+    with pytest.raises(PersistenceError):
+        persistence.persist_document("assessment", {"x": 1})
+    assert not docs
+
+    with open(persistence.DEAD_LETTER_PATH, "a", encoding="utf-8") as fh:
+        fh.write('{"collection": "assessment", "da\n')
+    with open(persistence.DEAD_LETTER_PATH, encoding="utf-8") as fh:
+        document_id = json.loads(fh.readline())["document_id"]
+
+    result = persistence.replay_dead_letters()
+    assert result == {"replayed": 1, "remaining": 1, "undecodable": 1}
+    assert [str(_id) for _id in docs] == [document_id]
+
+    # Replaying the same record again is recognised as already stored
+    with open(persistence.DEAD_LETTER_PATH, "w", encoding="utf-8") as fh:
+        fh.write(json.dumps({"collection": "assessment", "document_id": document_id, "data": {"x": 1}}) + "\n")
+    assert persistence.replay_dead_letters()["replayed"] == 1
+    assert len(docs) == 1
@@ -0,0 +1,44 @@
+import random
+
+import pytest
+
+import prescription
+from prescription import prescribe, prescribe_many
+from schemas import Questionnaire
+
+
+def _random_questionnaire(rng: random.Random) -> Questionnaire:
+    return Questionnaire(
+        objetivo=rng.choice(prescription.OBJETIVOS),
+        nivel=rng.choice(prescription.NIVEIS),
+        sexo=rng.choice(prescription.SEXOS),
+        idade=rng.choice([None, rng.randint(10, 100)]),
+        altura_cm=rng.choice([None, rng.randint(120, 230)]),
+        peso_kg=rng.choice([None, round(rng.uniform(30, 300), 1)]),
+        comprometimento_nota=rng.choice([None, rng.randint(0, 10)]),
+        sono_rotina_qualidade=rng.choice([None, "ruim", "boa", "normal", "durmo pouco"]),
+        estresse_nivel=rng.choice([None, "alto", "baixo", "médio"]),
+        sessoes_semana=rng.randint(2, 7),
+        tempo_por_sessao_min=rng.randint(15, 120),
+    )
+
+
+@pytest.mark.skipif(prescription.np is None, reason="NumPy not installed")
+def test_bulk_matches_scalar_path():
+    rng = random.Random(20261019)
+    questionnaires = [_random_questionnaire(rng) for _ in range(2000)]
+
+    bulk = prescribe_many(questionnaires)
+    scalar = [prescribe(q) for q in questionnaires]
+    assert bulk == scalar
+    # repr also catches int/float drift that == would let through (3 == 3.0)
+    assert repr(bulk) == repr(scalar)
+
+
+@pytest.mark.skipif(prescription.np is None, reason="NumPy not installed")
+def test_bulk_plans_match_single_plans():
+    from planner import build_plan, build_plans
+
+    rng = random.Random(7)
+    questionnaires = [_random_questionnaire(rng) for _ in range(200)]
+    assert build_plans(questionnaires, "en") == [build_plan(q, "en") for q in questionnaires]